@@ -0,0 +1,48 @@
+""" Layout of a whole document (e.g. to export or print) in a pool of processes.
+
+    The paragraphs are sent by chunks to the workers which measure with a headless backend
+    (see textextend_utils.SetMeasureBackend) and return the heights of the lines of each paragraph.
+    Images are laid out with their placeholder size, read from the image header.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from editor.richtext import PaintedParagraph
+from editor.textextend_utils import SetMeasureBackend, FixedAdvanceBackend
+from editor.imagecache import IMAGE_CACHE
+from editor.pagination import paginate
+
+
+def init_worker(backend):
+    SetMeasureBackend(backend)
+    IMAGE_CACHE.decoding = False
+
+
+def layout_chunk(start, paragraphs, max_width):
+    """ Line heights of each paragraph """
+    return [PaintedParagraph.from_paragraph(start + i, paragraph, max_width).GetLineHeights()
+            for i, paragraph in enumerate(paragraphs)]
+
+
+class BatchLayout():
+    def __init__(self, backend=None, workers=None, chunk_size=64):
+        """ backend: the MeasureBackend of the workers, a FixedAdvanceBackend by default.
+            workers: number of processes, the number of CPUs by default.
+        """
+        self.backend = backend or FixedAdvanceBackend()
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+    def GetLineHeights(self, paragraphs, max_width):
+        """ [[line heights of paragraph 0], [line heights of paragraph 1], ...] """
+        starts = range(0, len(paragraphs), self.chunk_size)
+        chunks = [paragraphs[start:start+self.chunk_size] for start in starts]
+        result = []
+        with ProcessPoolExecutor(self.workers, initializer=init_worker, initargs=(self.backend,)) as executor:
+            for heights in executor.map(layout_chunk, starts, chunks, repeat(max_width)):
+                result.extend(heights)
+        return result
+
+    def Paginate(self, document, max_width, page_height):
+        """ Returns (line heights of each paragraph, [(paragraph, line) starting each page]) """
+        line_heights = self.GetLineHeights(document.elements, max_width)
+        return (line_heights, list(paginate(line_heights, page_height)))
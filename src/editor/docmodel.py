@@ -1,10 +1,11 @@
-import wx
+import hashlib
 from enum import Enum
 from editor.event import Event
 
 FontWeight = Enum("FontWeight", "Normal Light Bold")
 FontStyle = Enum("FontStyle", "Normal Slant Italic")
 FontFamily = Enum("FontStyle", "Default Decorative Roman Script Swiss Modern")
+Alignment = Enum("Alignment", "Left Center Right Justify")
 
 #actions
 #  inserscharachers
@@ -196,26 +197,47 @@ class TextStyle():
         self.fontname = fontname
 
     def GetWxFont(self):
+        import wx
         font = wx.Font(self.point_size, self.GetWxFontFamily(), self.GetWxFontStyle(), self.GetWxFontWeight(), self.underline)
         #No idea why it is not saved from above...
         font.SetPointSize(self.point_size)
         return font
 
     def GetWxFontFamily(self):
+        import wx
         if not self.fontfamily:
             return wx.DEFAULT
         return {FontFamily.Default: wx.DEFAULT, FontFamily.Decorative: wx.DECORATIVE, FontFamily.Roman: wx.ROMAN,
                 FontFamily.Script: wx.SCRIPT, FontFamily.Swiss: wx.SWISS, FontFamily.Modern: wx.MODERN}[self.fontfamily]
 
     def GetWxFontStyle(self):
+        import wx
         return {FontStyle.Normal: wx.NORMAL, FontStyle.Slant: wx.SLANT, FontStyle.Italic: wx.ITALIC}[self.style]
 
     def GetWxFontWeight(self):
+        import wx
         return {FontWeight.Normal: wx.NORMAL, FontWeight.Light: wx.LIGHT, FontWeight.Bold: wx.BOLD}[self.weight]
 
     def clone(self):
         return TextStyle(self.point_size, self.weight, self.style, self.underline, self.fontfamily, self.fontname)
 
+    def key(self):
+        """ Equal for styles with the same attributes (e.g. clones), used by the caches """
+        return (self.point_size, self.weight, self.style, self.underline, self.fontfamily, self.fontname)
+
+
+class ParagraphStyle():
+    """ optimal_wrap: choose the line breaks of the whole text of each RichText (Knuth-Plass) instead of filling lines one by one """
+    def __init__(self, alignment=Alignment.Left, optimal_wrap=False):
+        self.alignment = alignment
+        self.optimal_wrap = optimal_wrap
+
+    def clone(self):
+        return ParagraphStyle(self.alignment, self.optimal_wrap)
+
+    def __repr__(self):
+        return f"ParagraphStyle<{self.alignment}, {self.optimal_wrap}>"
+
 
 class RichTextElement():
     pass
@@ -228,9 +250,20 @@ def list_remove(lst, offset, count):
 
 class RichText(RichTextElement):
     def __init__(self, text, style=None):
+        self.version = 0
         self.text = text
         self.style = style
 
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        """ Any change of the text changes the version (used by caches of text layout) """
+        self._text = text
+        self.version += 1
+
     def length(self):
         return len(self.text)
 
@@ -254,6 +287,13 @@ class RichText(RichTextElement):
 class Image(RichTextElement):
     def __init__(self, image_data, fileformat="jpg", style=None):
         self.image_data = image_data
+        self._key = None
+
+    def key(self):
+        """ Hash of the image data, used by the caches of decoded images """
+        if self._key is None:
+            self._key = hashlib.sha1(self.image_data).hexdigest()
+        return self._key
 
     def length(self):
         return 1
@@ -348,11 +388,33 @@ class Selection():
     def ContainsParagraph(self, pos):
         return (self.start.paragraph_id <= pos <= self.end.paragraph_id)
 
+    def ParagraphRange(self, pos):
+        """ (start, end) carets of the selected part of the paragraph at pos, None meaning the start or end of the paragraph.
+            None if the paragraph is not selected.
+        """
+        if not self.ContainsParagraph(pos):
+            return None
+        return (self.start if self.start.paragraph_id == pos else None,
+                self.end if self.end.paragraph_id == pos else None)
+
     def __hash__(self):
         return hash((self.start, self.end))
 
     def __repr__(self):
         return (f"<Selection: {self.start}, {self.end}>")
+
+
+def selection_changes(old_selection, selection):
+    """ Ranges of paragraphs containing every paragraph whose selected part differs between the two selections:
+        the symmetric difference of the selected paragraphs, plus the paragraphs at the ends of both selections.
+        The paragraphs selected entirely by both are not included.
+    """
+    spans = [(s.start.paragraph_id, s.end.paragraph_id) for s in (old_selection, selection) if s is not None]
+    if len(spans) < 2 or spans[0][1] < spans[1][0] or spans[1][1] < spans[0][0]:
+        return [range(first, last + 1) for first, last in spans]
+    (old_first, old_last), (first, last) = spans
+    return [range(min(old_first, first), max(old_first, first) + 1),
+            range(min(old_last, last), max(old_last, last) + 1)]
     
 class CharacterRangeWithId():
     """ Range of characters in a RichText"""
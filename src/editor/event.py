@@ -1,3 +1,5 @@
+import weakref
+
 
 class AllreadySubscribedException(Exception):
     pass
@@ -101,6 +103,15 @@ class Event(object):
             raise AllreadySubscribedException(callback)
         self.listeners[callback] = Listener(callback, CallArgs(args, kwargs))
 
+    def subscribe_weak(self, method, *args, **kwargs):
+        """ Subscribes a bound method without keeping its object alive: it is unsubscribed when the object is deleted """
+        def callback(*args, **kwargs):
+            method = ref()
+            if method is not None:
+                return method(*args, **kwargs)
+        ref = weakref.WeakMethod(method, lambda ref: self.listeners.pop(callback, None))
+        self.subscribe(callback, *args, **kwargs)
+
     def unsubscribe(self, callback):
         if callback not in self.listeners:
             raise NotSubscribedException(callback)
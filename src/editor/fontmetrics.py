@@ -0,0 +1,85 @@
+""" Horizontal metrics read from a TrueType font file (head, hhea, hmtx and cmap tables), without wx or FreeType.
+    Kerning and shaping are ignored: the advance of a text is the sum of the advances of its characters.
+"""
+import struct
+
+
+class TrueTypeMetrics():
+    def __init__(self, data):
+        if data[:4] == b"ttcf":
+            raise ValueError("Font collections are not supported")
+        num_tables, = struct.unpack(">H", data[4:6])
+        self.tables = {}
+        for i in range(num_tables):
+            tag, checksum, offset, length = struct.unpack(">4sIII", data[12+16*i:28+16*i])
+            self.tables[tag.decode("latin-1")] = (offset, length)
+        for tag in ("head", "hhea", "hmtx", "cmap"):
+            if tag not in self.tables:
+                raise ValueError(f"Missing table '{tag}'")
+        self.data = data
+        head = self.tables["head"][0]
+        self.units_per_em, = struct.unpack(">H", data[head+18:head+20])
+        hhea = self.tables["hhea"][0]
+        self.ascender, self.descender, self.line_gap = struct.unpack(">hhh", data[hhea+4:hhea+10])
+        num_metrics, = struct.unpack(">H", data[hhea+34:hhea+36])
+        hmtx = self.tables["hmtx"][0]
+        glyph_advances = [advance for advance, lsb in struct.iter_unpack(">Hh", data[hmtx:hmtx+4*num_metrics])]
+        self.advances = {}
+        for codepoint, glyph in self.read_cmap().items():
+            # Glyphs after numberOfHMetrics have the advance of the last one
+            self.advances[codepoint] = glyph_advances[min(glyph, num_metrics - 1)]
+        self.default_advance = glyph_advances[0]
+        del self.data
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "rb") as f:
+            return cls(f.read())
+
+    def u16(self, pos):
+        return struct.unpack(">H", self.data[pos:pos+2])[0]
+
+    def read_cmap(self):
+        """ {codepoint: glyph index} of the best unicode subtable (format 12 or 4) """
+        cmap = self.tables["cmap"][0]
+        num_subtables = self.u16(cmap+2)
+        subtables = {}
+        for i in range(num_subtables):
+            platform, encoding, offset = struct.unpack(">HHI", self.data[cmap+4+8*i:cmap+12+8*i])
+            subtables[(platform, encoding)] = cmap + offset
+        for platform_encoding in ((3, 10), (0, 4), (0, 6)):
+            if platform_encoding in subtables and self.u16(subtables[platform_encoding]) == 12:
+                return self.read_cmap_format12(subtables[platform_encoding])
+        for platform_encoding in ((3, 1), (0, 3), (0, 2), (0, 1), (0, 0)):
+            if platform_encoding in subtables and self.u16(subtables[platform_encoding]) == 4:
+                return self.read_cmap_format4(subtables[platform_encoding])
+        raise ValueError("No unicode cmap subtable")
+
+    def read_cmap_format4(self, pos):
+        seg_count = self.u16(pos+6) // 2
+        ends = pos + 14
+        starts = ends + 2*seg_count + 2
+        deltas = starts + 2*seg_count
+        range_offsets = deltas + 2*seg_count
+        result = {}
+        for i in range(seg_count):
+            end, start = self.u16(ends+2*i), self.u16(starts+2*i)
+            delta, range_offset = self.u16(deltas+2*i), self.u16(range_offsets+2*i)
+            for c in range(start, min(end, 0xFFFE) + 1):
+                if range_offset == 0:
+                    glyph = (c + delta) & 0xFFFF
+                else:
+                    glyph = self.u16(range_offsets + 2*i + range_offset + 2*(c - start))
+                    if glyph:
+                        glyph = (glyph + delta) & 0xFFFF
+                if glyph:
+                    result[c] = glyph
+        return result
+
+    def read_cmap_format12(self, pos):
+        num_groups, = struct.unpack(">I", self.data[pos+12:pos+16])
+        result = {}
+        for start, end, start_glyph in struct.iter_unpack(">III", self.data[pos+16:pos+16+12*num_groups]):
+            for c in range(start, end + 1):
+                result[c] = start_glyph + c - start
+        return result
@@ -0,0 +1,257 @@
+import wx
+import io
+import struct
+import queue
+from threading import Thread
+from collections import OrderedDict
+from editor.event import Event
+
+
+def image_size(data):
+    """ (width, height) read from the header of a PNG, GIF, BMP or JPEG image, None if unknown """
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and data[12:16] == b"IHDR":
+        return struct.unpack(">II", data[16:24])
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return struct.unpack("<HH", data[6:10])
+    if data[:2] == b"BM" and len(data) >= 26:
+        width, height = struct.unpack("<ii", data[18:26])
+        return (width, abs(height))
+    if data[:2] == b"\xff\xd8":
+        # Walk the JPEG segments until the start of frame
+        pos = 2
+        while pos + 9 < len(data):
+            if data[pos] != 0xFF:
+                return None
+            marker = data[pos+1]
+            if marker == 0xFF:
+                pos += 1
+            elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                pos += 2
+            elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[pos+5:pos+9])
+                return (width, height)
+            else:
+                pos += 2 + struct.unpack(">H", data[pos+2:pos+4])[0]
+    return None
+
+
+TILE_HEIGHT = 256
+
+
+def mip_level(full_width, width):
+    """ The level (full_width divided by 2**level) closest to width, but not smaller """
+    level = 0
+    while (full_width >> (level + 1)) >= width:
+        level += 1
+    return level
+
+
+def image_bytes(image):
+    return image.GetWidth() * image.GetHeight() * (4 if image.HasAlpha() else 3)
+
+
+class TiledBitmap():
+    """ A bitmap cut in horizontal tiles, so that only the visible part of a tall image is drawn """
+    def __init__(self, image):
+        self.width = image.GetWidth()
+        self.height = image.GetHeight()
+        self.tiles = []
+        for y in range(0, self.height, TILE_HEIGHT):
+            tile = image.GetSubImage(wx.Rect(0, y, self.width, min(TILE_HEIGHT, self.height - y)))
+            self.tiles.append((y, wx.Bitmap(tile, 32)))
+
+    def GetWidth(self):
+        return self.width
+
+    def GetHeight(self):
+        return self.height
+
+    def Bytes(self):
+        return self.width * self.height * 4
+
+    def Draw(self, dc, x, y):
+        clip_x, clip_y, clip_width, clip_height = dc.GetClippingBox()
+        for tile_y, bitmap in self.tiles:
+            # An empty clipping box means no clipping
+            if clip_height and (y + tile_y >= clip_y + clip_height or y + tile_y + bitmap.GetHeight() <= clip_y):
+                continue
+            dc.DrawBitmap(bitmap, x, y + tile_y)
+
+
+class ImageCache():
+    """ Images scaled down to the layout width, keyed by the hash of their content.
+
+        Decoding keeps only a reduced level of the image (its size divided by a power of 2, just above
+        the needed width): other widths (e.g. a zoom) are scaled from the nearest cached level.
+        Images are decoded in a background thread: GetBitmap returns None until a level is ready (the size
+        is read from the image header for a placeholder), then DECODED is fired with the key.
+        Levels and bitmaps are evicted least recently used first when they use more than max_bytes.
+    """
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.bitmaps = OrderedDict() # (key, width) => TiledBitmap
+        self.upscaled = set() # (key, width) of the bitmaps scaled up while a larger level is decoded
+        self.levels = OrderedDict() # key => {level: wx.Image}
+        self.sizes = {} # key => full (width, height)
+        self.size_bytes = 0
+        self.pending = set() # (key, level) being decoded
+        self.failed = set()
+        self.queue = queue.Queue()
+        self.thread = None
+        self.decoding = True # False: only placeholders, e.g. for a layout without wx.App
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.DECODED = Event()
+
+    def GetSize(self, image):
+        """ Full (width, height) of the image or None if it is unknown before decoding """
+        key = image.key()
+        if key not in self.sizes:
+            self.sizes[key] = image_size(image.image_data)
+        return self.sizes[key]
+
+    def GetDisplaySize(self, image, max_width=None):
+        """ (width, height) once scaled down to max_width """
+        size = self.GetSize(image)
+        if size is None:
+            return (0, 0)
+        full_width, full_height = size
+        if not max_width or max_width <= 0 or full_width <= max_width:
+            return size
+        return (max_width, max(1, full_height * max_width // full_width))
+
+    def GetBitmap(self, image, max_width=None):
+        """ The TiledBitmap of the image scaled down to max_width, or None while it is decoded """
+        key = image.key()
+        if key in self.failed or not self.decoding:
+            return None
+        if self.GetSize(image) is None or wx.GetApp() is None:
+            # No size for a placeholder, or no event loop to receive the result: decode now
+            if key not in self.levels:
+                self.AddLevel(key, *self.Decode(image.image_data, max_width))
+            if key in self.failed:
+                return None
+        width, height = self.GetDisplaySize(image, max_width)
+        bitmap = self.bitmaps.get((key, width))
+        if bitmap is not None:
+            self.hits += 1
+            self.bitmaps.move_to_end((key, width))
+            self.levels.move_to_end(key)
+            return bitmap
+        self.misses += 1
+        level_image = self.NearestLevel(key, width)
+        if level_image is None:
+            self.DecodeAsync(key, image.image_data, width)
+            return None
+        if level_image.GetWidth() < width:
+            # Zooming in: show the largest level until a better one is decoded (AddLevel drops this bitmap)
+            self.DecodeAsync(key, image.image_data, width)
+            bitmap = TiledBitmap(level_image.Scale(width, height, wx.IMAGE_QUALITY_NORMAL))
+            self.upscaled.add((key, width))
+        else:
+            bitmap = TiledBitmap(level_image.Scale(width, height, wx.IMAGE_QUALITY_HIGH))
+        self.bitmaps[(key, width)] = bitmap
+        self.size_bytes += bitmap.Bytes()
+        self.Trim()
+        return bitmap
+
+    def IsUpscaled(self, key, width):
+        """ True if the bitmap of GetBitmap was scaled up from a smaller level, DECODED is fired for a better one """
+        return (key, width) in self.upscaled
+
+    def NearestLevel(self, key, width):
+        """ The smallest cached level at least as wide as width, or else the largest one """
+        levels = self.levels.get(key)
+        if not levels:
+            return None
+        self.levels.move_to_end(key)
+        images = sorted(levels.values(), key=lambda image: image.GetWidth())
+        for image in images:
+            if image.GetWidth() >= width:
+                return image
+        return images[-1]
+
+    def Decode(self, data, width=None):
+        """ Returns (level, wx.Image of the level) """
+        image = wx.Image(io.BytesIO(data))
+        if not image.IsOk():
+            return (None, image)
+        full_width, full_height = image.GetWidth(), image.GetHeight()
+        level = mip_level(full_width, width) if width else 0
+        if level:
+            image = image.Scale(full_width >> level, max(1, full_height >> level), wx.IMAGE_QUALITY_BOX_AVERAGE)
+        return (level, image)
+
+    def DecodeAsync(self, key, data, width):
+        """ Decodes the level for width in the background thread, once per (key, level) """
+        size = self.sizes.get(key)
+        request = (key, (mip_level(size[0], width) if width else 0) if size else None)
+        if request in self.pending:
+            return
+        self.pending.add(request)
+        if self.thread is None:
+            self.thread = Thread(target=self.DecodeLoop, daemon=True)
+            self.thread.start()
+        self.queue.put((request, data, width))
+
+    def DecodeLoop(self):
+        while True:
+            request, data, width = self.queue.get()
+            level, image = self.Decode(data, width)
+            wx.CallAfter(self.OnDecoded, request, level, image)
+
+    def OnDecoded(self, request, level, image):
+        """ request: (key, level) given to DecodeAsync. DECODED is also fired if the image can't be decoded
+            (IsFailed), so that the placeholders stop waiting for it.
+        """
+        self.pending.discard(request)
+        key = request[0]
+        self.AddLevel(key, level, image)
+        self.DECODED.fire(key)
+
+    def IsFailed(self, key):
+        """ True if the image can't be decoded: GetBitmap will always return None """
+        return key in self.failed
+
+    def AddLevel(self, key, level, image):
+        if not image.IsOk():
+            self.failed.add(key)
+            return
+        self.sizes[key] = (image.GetWidth() << level, image.GetHeight() << level)
+        levels = self.levels.setdefault(key, {})
+        if level in levels:
+            self.size_bytes -= image_bytes(levels[level])
+        levels[level] = image
+        # The bitmaps scaled up from a smaller level are made again from this one
+        for bitmap_key in [k for k in self.upscaled if k[0] == key]:
+            self.RemoveBitmap(bitmap_key)
+        self.levels.move_to_end(key)
+        self.size_bytes += image_bytes(image)
+        self.Trim()
+
+    def RemoveBitmap(self, bitmap_key):
+        self.size_bytes -= self.bitmaps.pop(bitmap_key).Bytes()
+        self.upscaled.discard(bitmap_key)
+
+    def SetMaxBytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.Trim()
+
+    def Trim(self):
+        # Bitmaps can be scaled again from the levels: evict them first. Keep at least one level.
+        while self.size_bytes > self.max_bytes and self.bitmaps:
+            self.RemoveBitmap(next(iter(self.bitmaps)))
+            self.evictions += 1
+        while self.size_bytes > self.max_bytes and len(self.levels) > 1:
+            key, levels = self.levels.popitem(last=False)
+            self.size_bytes -= sum(image_bytes(image) for image in levels.values())
+            self.evictions += 1
+
+    def Stats(self):
+        return {"bitmaps": len(self.bitmaps), "levels": sum(len(levels) for levels in self.levels.values()),
+                "bytes": self.size_bytes, "max_bytes": self.max_bytes, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions, "pending": len(self.pending)}
+
+
+IMAGE_CACHE = ImageCache()
@@ -0,0 +1,160 @@
+""" Line break opportunities, a simplified version of the Unicode line breaking algorithm (UAX #14).
+
+    Each character is mapped to its break class with str.translate on a precomputed table,
+    the break opportunities are then found by a regex built from a pair table of the classes.
+    There is no python code run per character.
+"""
+import re
+import weakref
+
+# Break classes (one letter each, so that a text translates to a string of classes)
+BK = "B" # Mandatory break (newlines)
+SP = "S" # Space
+GL = "G" # Glue: non breaking spaces, word joiner
+ZW = "Z" # Zero width space
+OP = "O" # Opening punctuation
+CL = "C" # Closing punctuation
+QU = "Q" # Quotation marks
+EX = "X" # Exclamation and interrogation
+IS = "I" # Infix separators (, . : ;)
+SY = "Y" # Symbols allowing a break after (/)
+HY = "H" # Hyphen
+BA = "T" # Break after: tabs, dashes, spaces of other widths
+NS = "N" # Nonstarters: small kana, iteration marks
+ID = "D" # Ideographic
+CM = "M" # Combining marks
+AL = "A" # Alphabetic, numbers and everything else
+CLASSES = (BK, SP, GL, ZW, OP, CL, QU, EX, IS, SY, HY, BA, NS, ID, CM, AL)
+
+# (first, last, class). Applied in order, BREAK_CLASS_CHARS has priority
+BREAK_CLASS_RANGES = [
+    (0x0300, 0x036F, CM),
+    (0x0483, 0x0489, CM),
+    (0x0591, 0x05BD, CM),
+    (0x0610, 0x061A, CM),
+    (0x064B, 0x065F, CM),
+    (0x200C, 0x200D, CM),
+    (0x20D0, 0x20FF, CM),
+    (0x2E80, 0x2FFF, ID),
+    (0x3040, 0x30FF, ID),
+    (0x3400, 0x4DBF, ID),
+    (0x4E00, 0x9FFF, ID),
+    (0xAC00, 0xD7A3, ID),
+    (0xF900, 0xFAFF, ID),
+    (0xFE20, 0xFE2F, CM),
+    (0xFF01, 0xFF60, ID),
+]
+
+BREAK_CLASS_CHARS = {
+    BK: "\n\x0b\x0c\r\x85\u2028\u2029",
+    SP: " ",
+    GL: "\xa0\u0f0c\u2007\u2011\u202f\u2060\ufeff",
+    ZW: "\u200b",
+    OP: ("([{\xa1\xbf\u2045\u207d\u208d\u3008\u300a\u300c\u300e\u3010\u3014\u3016\u3018\u301a"
+         "\uff08\uff3b\uff5b\uff5f\uff62"),
+    CL: (")]}\u2046\u207e\u208e\u3001\u3002\u3009\u300b\u300d\u300f\u3011\u3015\u3017\u3019"
+         "\u301b\uff09\uff0c\uff0e\uff3d\uff5d\uff60\uff61\uff63\uff64"),
+    QU: "\"'\xab\xbb\u2018\u2019\u201c\u201d\u2039\u203a",
+    EX: "!?\u0589\u061f\uff01\uff1f",
+    IS: ",.:;\u037e\u060c\u060d\u2044\ufe10\ufe13\ufe14",
+    SY: "/",
+    HY: "-",
+    BA: ("\t|\xad\u058a\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2008\u2009\u200a"
+         "\u2010\u2012\u2013\u2027\u205f\u3000"),
+    NS: ("\u203c\u203d\u2047\u2048\u2049\u3005\u301c\u303b\u303c\u309b\u309c\u309d\u309e\u30a0"
+         "\u30fb\u30fc\u30fd\u30fe\u3041\u3043\u3045\u3047\u3049\u3063\u3083\u3085\u3087\u308e"
+         "\u3095\u3096\u30a1\u30a3\u30a5\u30a7\u30a9\u30c3\u30e3\u30e5\u30e7\u30ee\u30f5\u30f6"
+         "\uff1a\uff1b\uff65\uff9e\uff9f"),
+}
+
+
+def build_break_class_table():
+    """ A string with the break class of each code point of the Basic Multilingual Plane """
+    table = [AL] * 0x10000
+    for first, last, cls in BREAK_CLASS_RANGES:
+        table[first:last+1] = [cls] * (last + 1 - first)
+    for cls, chars in BREAK_CLASS_CHARS.items():
+        for c in chars:
+            table[ord(c)] = cls
+    return "".join(table)
+
+
+def pair_allows_break(before, after):
+    """ The UAX #14 rules that only depend on two adjacent classes """
+    if before == BK:
+        return True
+    if after in (BK, SP, ZW):
+        return False
+    if before == ZW:
+        return True
+    if after == CM:
+        return False
+    if before == GL or (after == GL and before not in (SP, BA, HY)):
+        return False
+    if after in (CL, EX, IS, SY) or before == OP:
+        return False
+    if before == QU or after == QU:
+        return False
+    if after in (BA, HY, NS):
+        return False
+    # No break inside words and numbers, and between words and brackets
+    if after == AL and before in (AL, CM, IS, CL):
+        return False
+    if after == OP and before in (AL, CM):
+        return False
+    return True
+
+
+def build_break_regex():
+    """ Matches at position p if a line can be broken between p and p+1 """
+    pairs = []
+    for before in CLASSES:
+        afters = "".join(after for after in CLASSES if pair_allows_break(before, after))
+        if afters:
+            pairs.append(f"{before}[{afters}]")
+    return re.compile("(?=%s)" % "|".join(pairs))
+
+
+BREAK_CLASS_TABLE = build_break_class_table()
+BREAK_RE = build_break_regex()
+# Outside of the table: ideographic planes and emojis are ID, the rest is AL
+SUPPLEMENTARY_ID_RE = re.compile("[\U0001F300-\U0001FAFF\U00020000-\U0003FFFD]")
+UNKNOWN_CLASS_RE = re.compile("[^%s]" % "".join(CLASSES))
+
+# A line must end after these characters, CR LF being a single break
+MANDATORY_BREAK_RE = re.compile("\r\n|[%s]" % BREAK_CLASS_CHARS[BK])
+
+Breaks_cache = weakref.WeakKeyDictionary()
+
+
+def break_classes(text):
+    """ The text translated to one break class letter per character """
+    classes = text.translate(BREAK_CLASS_TABLE)
+    if not classes.isascii():
+        # Characters above the BMP are left untouched by translate
+        classes = UNKNOWN_CLASS_RE.sub(AL, SUPPLEMENTARY_ID_RE.sub(ID, classes))
+    return classes
+
+
+def line_breaks(text):
+    """ Sorted positions 'pos' such that a line can end with text[:pos]. len(text) is always included. """
+    if not text:
+        return []
+    result = [m.start() + 1 for m in BREAK_RE.finditer(break_classes(text))]
+    if "\r\n" in text:
+        result = [pos for pos in result if text[pos-1:pos+1] != "\r\n"]
+    result.append(len(text))
+    return result
+
+
+def mandatory_breaks(text):
+    """ Sorted positions 'pos' such that a line must end with text[:pos] (after a newline) """
+    return [m.end() for m in MANDATORY_BREAK_RE.finditer(text)]
+
+
+def line_breaks_cached(rich_text):
+    """ line_breaks of a RichText, computed again only when its text version changes """
+    cached = Breaks_cache.get(rich_text)
+    if cached is None or cached[0] != rich_text.version:
+        cached = Breaks_cache[rich_text] = (rich_text.version, line_breaks(rich_text.text))
+    return cached[1]
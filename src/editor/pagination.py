@@ -0,0 +1,205 @@
+""" Splitting of the laid out paragraphs in pages, at line boundaries """
+import wx
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from editor.docmodel import ParagraphChange
+from editor.richtext import PaintedParagraph
+
+
+def paginate(paragraph_line_heights, page_height, start=(0, 0)):
+    """ Yields the (paragraph, line) starting each page, from 'start' which begins a page.
+        paragraph_line_heights: the heights of the lines of each paragraph.
+        Pages are filled with whole lines, a line taller than a page is alone on its page.
+    """
+    yield start
+    first_paragraph, first_line = start
+    used = 0
+    for paragraph in range(first_paragraph, len(paragraph_line_heights)):
+        heights = paragraph_line_heights[paragraph]
+        for line in range(first_line if paragraph == first_paragraph else 0, len(heights)):
+            height = heights[line]
+            if used and used + height > page_height:
+                yield (paragraph, line)
+                used = 0
+            used += height
+
+
+class Paginator():
+    """ Incremental page index of a document: the (paragraph, line) starting each page.
+
+        Paragraphs are laid out (at the page width) only when the pages are needed.
+        After an edit, the pages are computed again from the page of the edited paragraph until a page
+        starts at the same line as before: the following pages are unchanged.
+    """
+    def __init__(self, document, page_width, page_height, max_cached=64):
+        self.document = document
+        self.page_width = page_width
+        self.page_height = page_height
+        self.line_heights = [None] * len(document.elements) # None: not laid out yet
+        self.page_starts = [(0, 0)]
+        self.complete = False # page_starts goes until the end of the document
+        self.painted = OrderedDict() # pos => PaintedParagraph, least recently used first
+        self.max_cached = max_cached
+
+    def __len__(self):
+        # Makes the Paginator a list of line heights for paginate
+        return len(self.line_heights)
+
+    def __getitem__(self, pos):
+        if self.line_heights[pos] is None:
+            self.line_heights[pos] = self.GetPaintedParagraph(pos).GetLineHeights()
+        return self.line_heights[pos]
+
+    def GetPaintedParagraph(self, pos):
+        painted = self.painted.get(pos)
+        if painted is None:
+            painted = self.painted[pos] = PaintedParagraph.from_paragraph(pos, self.document.elements[pos], self.page_width)
+            if len(self.painted) > self.max_cached:
+                self.painted.popitem(last=False)
+        else:
+            self.painted.move_to_end(pos)
+        return painted
+
+    def Extend(self, page):
+        """ Paginates until 'page' is known or the end of the document """
+        if self.complete or page < len(self.page_starts):
+            return
+        pages = paginate(self, self.page_height, self.page_starts[-1])
+        next(pages)
+        for start in pages:
+            self.page_starts.append(start)
+            if page < len(self.page_starts):
+                return
+        self.complete = True
+
+    def HasPage(self, page):
+        self.Extend(page)
+        return 0 <= page < len(self.page_starts)
+
+    def GetPageStart(self, page):
+        self.Extend(page)
+        return self.page_starts[page]
+
+    def GetPageCount(self):
+        """ Paginates the whole document """
+        while not self.complete:
+            self.Extend(len(self.page_starts))
+        return len(self.page_starts)
+
+    def EstimatePageCount(self):
+        """ The page count, extrapolated from the pages already known """
+        if self.complete:
+            return len(self.page_starts)
+        paragraph = self.page_starts[-1][0]
+        if paragraph == 0:
+            return len(self.page_starts)
+        return max(len(self.page_starts), len(self.page_starts) * len(self.line_heights) // paragraph)
+
+    def GetPageOf(self, paragraph, line=0):
+        """ Page of a line in O(log(pages)) """
+        self.ExtendTo(paragraph, line)
+        return bisect_right(self.page_starts, (paragraph, line)) - 1
+
+    def ExtendTo(self, paragraph, line):
+        while not self.complete and self.page_starts[-1] <= (paragraph, line):
+            self.Extend(len(self.page_starts))
+
+    def IteratePageLines(self, page):
+        """ Yields (paragraph, first_line, end_line) of the parts of paragraphs on the page """
+        paragraph, line = self.GetPageStart(page)
+        if self.HasPage(page + 1):
+            end = self.page_starts[page + 1]
+        else:
+            end = (len(self.line_heights), 0)
+        while (paragraph, line) < end:
+            end_line = end[1] if paragraph == end[0] else len(self[paragraph])
+            if end_line > line:
+                yield (paragraph, line, end_line)
+            paragraph, line = paragraph + 1, 0
+
+    def PaintPage(self, dc, page, x=0, y=0):
+        for paragraph, first_line, end_line in self.IteratePageLines(page):
+            painted = self.GetPaintedParagraph(paragraph)
+            tops, bottoms, lines = painted.GetLineIndex()
+            top, bottom = tops[first_line], bottoms[end_line-1]
+            dc.SetClippingRegion(x, y, self.page_width, bottom - top)
+            painted.Paint(dc, x, y - top)
+            dc.DestroyClippingRegion()
+            y += bottom - top
+
+    def Repaginate(self, paragraph):
+        """ The line heights of paragraph changed: paginate from its page until the page starts converge """
+        if not self.line_heights:
+            self.page_starts, self.complete = [(0, 0)], True
+            return
+        paragraph = min(paragraph, len(self.line_heights) - 1)
+        old = self.page_starts
+        # The page before the paragraph (a page starting at the paragraph may have to move after a removal)
+        page = max(bisect_left(old, (paragraph, 0)) - 1, 0)
+        new = old[:page+1]
+        pages = paginate(self, self.page_height, old[page])
+        next(pages)
+        i = page + 1
+        for start in pages:
+            if start[0] > paragraph:
+                # The lines after the edited paragraph are unchanged: an old page start is valid again
+                i = bisect_left(old, start, i)
+                if i < len(old) and old[i] == start:
+                    self.page_starts = new + old[i:]
+                    return
+                if i == len(old) and not self.complete:
+                    # The next pages were not computed yet
+                    self.page_starts = new
+                    return
+            new.append(start)
+        self.page_starts = new
+        self.complete = True
+
+    def Modified(self, pos):
+        self.line_heights[pos] = None
+        self.painted.pop(pos, None)
+        self.Repaginate(pos)
+
+    def Inserted(self, pos, count=1):
+        self.line_heights[pos:pos] = [None] * count
+        self.page_starts = [(p + count, line) if p >= pos and (p, line) != (0, 0) else (p, line) for p, line in self.page_starts]
+        self.painted = OrderedDict(((p + count if p >= pos else p), painted) for p, painted in self.painted.items())
+        self.Repaginate(pos)
+
+    def Removed(self, pos, count=1):
+        del self.line_heights[pos:pos+count]
+        self.page_starts = [(0, 0)] + [(p - count if p >= pos + count else p, line)
+                                       for p, line in self.page_starts[1:] if not pos <= p < pos + count]
+        self.painted = OrderedDict(((p - count if p >= pos + count else p), painted)
+                                   for p, painted in self.painted.items() if not pos <= p < pos + count)
+        self.Repaginate(pos)
+
+    def ApplyChanges(self, changes):
+        """ changes: [(ParagraphChange, pos), ...] as returned by the actions """
+        for change, pos in changes:
+            if change is ParagraphChange.Modified:
+                self.Modified(pos)
+            elif change is ParagraphChange.Inserted:
+                self.Inserted(pos)
+            elif change is ParagraphChange.Removed:
+                self.Removed(pos)
+
+
+class PaginatedPrintout(wx.Printout):
+    """ Prints (or previews) the pages of a Paginator, scaled to the paper """
+    def __init__(self, paginator, title="Document"):
+        super().__init__(title)
+        self.paginator = paginator
+
+    def GetPageInfo(self):
+        count = self.paginator.EstimatePageCount()
+        return (1, count, 1, count)
+
+    def HasPage(self, page):
+        return self.paginator.HasPage(page - 1)
+
+    def OnPrintPage(self, page):
+        dc = self.GetDC()
+        self.FitThisSizeToPageMargins(wx.Size(self.paginator.page_width, self.paginator.page_height), wx.PageSetupDialogData())
+        self.paginator.PaintPage(dc, page - 1)
+        return True
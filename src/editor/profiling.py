@@ -0,0 +1,113 @@
+""" Switchable instrumentation of the layout, paint and model hot paths, recorded in util.PROFILE.
+
+    Enable() replaces the functions below by timed wrappers, Disable() puts the originals back:
+    there is no cost at all when the profiling is disabled.
+
+    >> from editor import profiling
+    >> profiling.Enable()
+    >> ... use the editor ...
+    >> profiling.Disable()
+    >> open("trace.json", "w").write(PROFILE.to_chrome_trace())
+"""
+import sys
+import time
+import inspect
+from functools import wraps
+from editor.util import PROFILE
+from editor import docmodel, event, richtext, scrolled, textextend_utils, wrapping
+
+# (owner, attribute, name in the profile)
+INSTRUMENTED = [
+    (richtext.PaintedParagraph, "from_paragraph", "layout.from_paragraph"),
+    (wrapping, "wrap_text", "layout.wrap_text"),
+    (textextend_utils, "GetPartialTextExtents", "measure.GetPartialTextExtents"),
+    (scrolled.RowScroller, "PaintRect", "paint.PaintRect"),
+    (scrolled.RowScroller, "BlitToScreen", "paint.BlitToScreen"),
+    (event.Event, "fire", "event.fire"),
+]
+
+Patches = [] # (owner, attribute, original)
+
+
+def timed(fct, name, profile):
+    @wraps(fct)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fct(*args, **kwargs)
+        finally:
+            profile.record(name, start, time.perf_counter() - start)
+    return wrapper
+
+
+def timed_generator(fct, name, profile):
+    """ Records the time spent inside the generator, not the time its consumer takes between the items """
+    @wraps(fct)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        duration = 0
+        iterator = fct(*args, **kwargs)
+        try:
+            while True:
+                t = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration as e:
+                    return e.value
+                finally:
+                    duration += time.perf_counter() - t
+                yield item
+        finally:
+            iterator.close()
+            profile.record(name, start, duration)
+    return wrapper
+
+
+def wrap(original, name, profile):
+    if isinstance(original, classmethod):
+        return classmethod(wrap(original.__func__, name, profile))
+    if isinstance(original, staticmethod):
+        return staticmethod(wrap(original.__func__, name, profile))
+    if inspect.isgeneratorfunction(original):
+        return timed_generator(original, name, profile)
+    return timed(original, name, profile)
+
+
+def patch(owner, attribute, name, profile):
+    original = vars(owner)[attribute]
+    wrapper = wrap(original, name, profile)
+    setattr(owner, attribute, wrapper)
+    Patches.append((owner, attribute, original))
+    if inspect.ismodule(owner):
+        # Also replace the references imported with 'from module import function'
+        for module_name, module in list(sys.modules.items()):
+            if module_name.startswith("editor.") and module is not owner and vars(module).get(attribute) is original:
+                setattr(module, attribute, wrapper)
+                Patches.append((module, attribute, original))
+
+
+def action_classes():
+    """ The Action classes defining do (the classes made later by ReverseAction are not included) """
+    classes = [docmodel.Action]
+    for cls in classes:
+        classes.extend(cls.__subclasses__())
+    return [cls for cls in classes if "do" in vars(cls)]
+
+
+def IsEnabled():
+    return bool(Patches)
+
+
+def Enable(profile=PROFILE):
+    if Patches:
+        return
+    for owner, attribute, name in INSTRUMENTED:
+        patch(owner, attribute, name, profile)
+    for cls in action_classes():
+        patch(cls, "do", f"action.{cls.__name__}", profile)
+
+
+def Disable():
+    while Patches:
+        owner, attribute, original = Patches.pop()
+        setattr(owner, attribute, original)
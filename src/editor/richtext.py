@@ -5,17 +5,23 @@ import io
 from editor.toolbar import RichTextToolbar
 from collections import defaultdict
 from editor.docmodel import TextStyle, Paragraph, Image, RichTextDocument,\
-    RichText, FontStyle, FontWeight, CaretPosition, Selection, InsertCharacters,\
+    RichText, FontStyle, FontWeight, CaretPosition, Selection, selection_changes, InsertCharacters,\
     MoveCaret, ParagraphChange, MergeParagraphWithNext, RemoveCharacters,\
     SplitElement, SplitParagraph, RemoveElement, RemoveParagraph,\
     ChangeSelection, CharacterRangeWithId, ParagraphWithId, ElementWithId,\
-    InsertParagraph, InsertElement
+    InsertParagraph, InsertElement, Alignment
 from editor.scrolled import RowScroller
-from editor.wrapping import wrap_text
-from editor.textextend_utils import GetTextExtentCached, GetPartialTextExtents
-from editor.util import clone_multiply_list
+from editor.rowstore import RowStore
+from editor.wrapping import wrap_text, HANGING_CHARS
+from editor.linebreak import line_breaks_cached, BREAK_CLASS_CHARS, BK
+from editor.imagecache import IMAGE_CACHE, TiledBitmap
+from editor.textextend_utils import GetTextExtentCached, GetPartialTextExtents, GetFontCached, DEFAULT_STYLE
+from editor.util import clone_multiply_list, PAINT_STATS
 from contextlib import contextmanager
 import collections
+from bisect import bisect_left, bisect_right
+import itertools
+import re
 
 debug = False
 """
@@ -48,6 +54,38 @@ features i would like:
 """
 
 CARET_WIDTH = 2
+SPACE_RE = re.compile(" ")
+WORD_RE = re.compile("[^ ]+")
+
+
+def layout_source(rich_text):
+    """ What the layout of a RichTextElement depends on (compared by PaintedParagraph.Rewrap) """
+    if type(rich_text) is RichText:
+        return (rich_text.text, rich_text.style and rich_text.style.key())
+    return (rich_text, None)
+
+
+def common_prefix_length(a, b):
+    # Bisect on slices compared in C, instead of a python loop per character
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def common_suffix_length(a, b, max_length):
+    low, high = 0, min(len(a), len(b), max_length)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[len(a)-mid:] == b[len(b)-mid:]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
 
 class CaretLayout():
     def __init__(self):
@@ -56,6 +94,7 @@ class CaretLayout():
     def Paint(self, dc,  rect):
         if self.visible:
             dc.SetPen(wx.BLACK_PEN)
+            dc.SetBrush(wx.BLACK_BRUSH)
             dc.DrawRectangle(rect.X, rect.Y, rect.Width, rect.Height)
 
 
@@ -75,17 +114,34 @@ class PaintedRichtext():
         self.selected = False
         self.start_offset = None
         self.end_offset = None
+        self.justified = False
 
     def __repr__(self):
         return (f"PaintedRichtext<{self.width}, {self.height}, {self.text}>" )
 
-    def Paint(self, dc, x, y):
-        if self.style:
-            dc.SetFont(self.style.GetWxFont())
+    def DrawTextRange(self, dc, x, y, start, end):
+        if self.justified:
+            # The spaces are wider than in the font: draw word by word
+            for m in WORD_RE.finditer(self.text, start, end):
+                dc.DrawText(m.group(), x+self.text_extends[m.start()], y)
+                PAINT_STATS.draw_calls += 1
         else:
-            dc.SetFont(TextStyle().GetWxFont())
+            dc.DrawText(self.text[start:end], x+self.text_extends[start], y)
+            PAINT_STATS.draw_calls += 1
+
+    def Paint(self, dc, x, y):
+        dc.SetFont(GetFontCached(self.style))
         dc.SetTextForeground(wx.Colour("black"))
-        dc.DrawText(self.text, x, y)
+        PAINT_STATS.state_changes += 1
+        self.PaintText(dc, x, y)
+        self.PaintOverlay(dc, x, y)
+
+    def PaintText(self, dc, x, y):
+        """ Draws the text with the font already selected in the dc """
+        self.DrawTextRange(dc, x, y, 0, len(self.text))
+
+    def PaintOverlay(self, dc, x, y):
+        """ Draws the selection, after the text (the caret is drawn by the control, over the screen) """
         if debug:
             dc.SetPen(wx.RED_PEN)
             dc.DrawRectangle(x+1, y+1, self.width-2, self.height-2)
@@ -99,12 +155,10 @@ class PaintedRichtext():
             dc.SetPen(wx.TRANSPARENT_PEN)
             dc.SetBrush(wx.Brush(bgcolor))
             dc.DrawRectangle(x+self.text_extends[start], y, self.text_extends[end]-self.text_extends[start], self.height)
+            dc.SetFont(GetFontCached(self.style))
             dc.SetTextForeground(fgcolor)
-            dc.DrawText(self.text[start:end], x+self.text_extends[start], y)
-        if self.caret is not None:
-            rect = self.GetCaretRect()
-            rect.Offset(x , y)
-            self.caret.Paint(dc, rect)
+            PAINT_STATS.state_changes += 1
+            self.DrawTextRange(dc, x, y, start, end)
 
     def SetCaret(self, caret, offset):
         self.caret = caret
@@ -119,24 +173,33 @@ class PaintedRichtext():
         self.start_offset = start_offset
         self.end_offset = end_offset
 
+    def TrailingSpaceWidth(self):
+        return self.text_extends[-1] - self.text_extends[len(self.text.rstrip(HANGING_CHARS))]
+
+    def Justify(self, extras):
+        """ Widens some spaces without measuring again.
+            extras: [(offset of the space, extra pixels), ...]
+        """
+        deltas = [0] * len(self.text_extends)
+        for offset, extra in extras:
+            deltas[offset+1] += extra
+        self.text_extends = [w + d for w, d in zip(self.text_extends, itertools.accumulate(deltas))]
+        self.width += sum(extra for _, extra in extras)
+        self.justified = True
+
     def HitTest(self, x, y):
         """ Returns (offset, before_split)
         """
         if self.text == "":
             return (0, True)
-        dc = wx.MemoryDC()
-        dc.SetFont(self.style.GetWxFont() if self.style else TextStyle().GetWxFont())
-        # Todo add Font
-        text_extends = dc.GetPartialTextExtents(self.text)
-        #text_extends2 = dc.GetTextExtent(self.text)
-        prev_w = 0
-        for i, w in enumerate(text_extends):
-            if x < w:
-                break
-            prev_w = w
-        middle = (prev_w + (w- prev_w) // 2)
-        #result = HitTestResult.Before if x < middle else HitTestResult.After
-        result = i if x < middle else i +1
+        # text_extends[i] is the width of text[:i]: it is sorted, so bisect it
+        i = bisect_right(self.text_extends, x, 1) - 1
+        if i == len(self.text):
+            result = i
+        else:
+            prev_w, w = self.text_extends[i], self.text_extends[i+1]
+            middle = (prev_w + (w- prev_w) // 2)
+            result = i if x < middle else i +1
         # Set before_split to True if we are at the end of a line
         before_split = (result == len(self.text))
         return (result, before_split)
@@ -148,8 +211,9 @@ class PaintedRichtext():
         
 class PaintedImage():
     MARGIN = 10
-    def __init__(self, width, height, wx_bitmap, style):
-        self.wx_bitmap = wx_bitmap
+    def __init__(self, width, height, bitmap, style):
+        """ bitmap: a TiledBitmap, or None for a placeholder """
+        self.bitmap = bitmap
         self.style = style
         self.width = width
         self.height = height
@@ -163,11 +227,13 @@ class PaintedImage():
             dc.SetPen(wx.TRANSPARENT_PEN)
             dc.SetBrush(wx.Brush(bgcolor))
             dc.DrawRectangle(x, y, self.width, self.height)
-        dc.DrawBitmap (self.wx_bitmap, x+self.MARGIN, y+self.MARGIN)
-        if self.caret is not None:
-            rect = self.GetCaretRect()
-            rect.Offset(x, y)
-            self.caret.Paint(dc, rect)
+        if self.bitmap is None:
+            # Placeholder while the image is decoded
+            dc.SetPen(wx.TRANSPARENT_PEN)
+            dc.SetBrush(wx.Brush(wx.Colour(230, 230, 230)))
+            dc.DrawRectangle(x+self.MARGIN, y+self.MARGIN, self.width-2*self.MARGIN, self.height-2*self.MARGIN)
+        else:
+            self.bitmap.Draw(dc, x+self.MARGIN, y+self.MARGIN)
 
     def HitTest(self, x, y):
         """ Returns (offset, before_split)
@@ -188,11 +254,21 @@ class PaintedImage():
     def SetSelected(self, selected, start_offset=None, end_offset=None):
         self.selected = selected
 
+    def TrailingSpaceWidth(self):
+        return 0
+
     @classmethod
     def from_wximage(cls, image):
-        bitmap = wx.Bitmap(image, 32)
+        return cls.from_bitmap(TiledBitmap(image))
+
+    @classmethod
+    def from_bitmap(cls, bitmap):
         return cls(bitmap.GetWidth() + 2*cls.MARGIN, bitmap.GetHeight() + 2*cls.MARGIN, bitmap, None)
 
+    @classmethod
+    def placeholder(cls, width, height):
+        return cls(width + 2*cls.MARGIN, height + 2*cls.MARGIN, None, None)
+
 
 class PositionedLayout():
     """ A RichtextLayout/ImageLayout with an added relative position (x,y).
@@ -255,8 +331,9 @@ class PositionedLayout():
 
 class PaintedParagraph():
     def __init__(self, paragraph_id, max_width, width=0, height=0):
-        self.paragraph_id = paragraph_id
+        self.paragraph_id = paragraph_id # the position when it was laid out (not shifted by the inserts/removes)
         self.max_width = max_width
+        self.last_used = 0
         self.height = height
         self.insert_x = 0
         self.insert_y = 0
@@ -264,9 +341,16 @@ class PaintedParagraph():
         self.lastline_height = 0
         self.elements = []
         self.lines = [[]]
-        self.elements_by_id = defaultdict(list) # id => [(line, PositionedLayout) , ...]   
+        self.element_keys = [] # sorted [(rich_text_idx, split_offset), ...], one per element
         self.current_line = 0
         self.paragraph_offsets = []
+        self.line_index = None
+        self.optimal_wrap = False
+        self.pending_images = [] # keys of the images with a placeholder or a bitmap scaled up
+        self.sources = [] # layout_source of each RichTextElement, for Rewrap
+        self.resync = None # During Rewrap: returns the old line where the wrapping can stop
+        self.resynced = None
+        self.break_after = False # the last text ended with a newline
 
     def __repr__(self):
         return (f"PaintedParagraph<{self.max_width}, {self.height}>" )
@@ -283,22 +367,36 @@ class PaintedParagraph():
         self.lines.append([])
         self.current_line += 1
         
-    def Append(self, idx, painted_obj, split_offset=0, split_offset_end=0):
-        """ Append to the last line """
-        if not self.HasSpace(painted_obj.width):
+    def Append(self, idx, painted_obj, split_offset=0, split_offset_end=0, new_line=None):
+        """ Append to the last line.
+            new_line: True to start a new line, False to stay on the current one, by default a new line is started
+            if painted_obj doesn't fit (and the line isn't empty) or after a newline character.
+        """
+        if new_line is None:
+            new_line = self.break_after or (not self.HasSpace(painted_obj.width) and bool(self.lines[self.current_line]))
+        self.break_after = False
+        if new_line:
             self.NextLine()
+            # Only a line whose start doesn't depend on the previous lines can be the same as an old one
+            if self.resync is not None and (split_offset > 0 or type(painted_obj) is PaintedImage):
+                self.resynced = self.resync(idx, split_offset)
+                if self.resynced is not None:
+                    return
         positionned_layout = PositionedLayout(self.insert_x, self.insert_y, painted_obj, idx, split_offset, split_offset_end)
         self.lines[self.current_line].append(positionned_layout)
-        self.elements_by_id[idx].append((self.current_line, positionned_layout))
+        self.element_keys.append((idx, split_offset))
+        self.line_index = None
         self.elements.append(positionned_layout)
         self.insert_x += painted_obj.width
         self.lastline_height = max(self.lastline_height, painted_obj.height)
         self.height = self.fullline_height + self.lastline_height
         
-    def AppendFlow(self, idx, rich_text):
-        """ Append an object by wrapping text, or moving images to next line if there is insufficient space"""
+    def AppendFlow(self, idx, rich_text, start=0):
+        """ Append an object by wrapping text, or moving images to next line if there is insufficient space.
+            start: offset in the text of a line start, to wrap only the end of the text
+        """
         if type(rich_text) is RichText:
-            rich_text_offset = 0
+            rich_text_offset = start
             if rich_text.text == "":
                 # For empty paragraphs
                 width, height = GetTextExtentCached("a", rich_text.style)
@@ -306,22 +404,129 @@ class PaintedParagraph():
                 painted_obj = PaintedRichtext(width, height, "", rich_text.style)
                 self.Append(idx, painted_obj, rich_text_offset, rich_text_offset)
             else:
-                for text in wrap_text(rich_text.text, rich_text.style, self.max_width, first_width=self.max_width - self.insert_x ):
+                breaks = line_breaks_cached(rich_text)
+                # The lines are the ones chosen by wrap_text: only the first one can go on the current line
+                new_line = None
+                for text in wrap_text(rich_text.text, rich_text.style, self.max_width, first_width=self.max_width - self.insert_x,
+                                      breaks=breaks, optimal=self.optimal_wrap, start=start):
                     width, height = GetTextExtentCached(text, rich_text.style)
 
                     painted_obj = PaintedRichtext(width, height, text, rich_text.style) #rich_text_offset
-                    self.Append(idx, painted_obj, rich_text_offset, rich_text_offset+len(text))
+                    self.Append(idx, painted_obj, rich_text_offset, rich_text_offset+len(text), new_line)
+                    if self.resynced is not None:
+                        return
+                    new_line = True
                     rich_text_offset += len(text)
+                self.break_after = rich_text.text[-1] in BREAK_CLASS_CHARS[BK]
         elif type(rich_text) is Image:
             # TODO: images should move to the next line if there isn't enough space
-            image = wx.Image(io.BytesIO(rich_text.image_data)) #wx.BITMAP_TYPE_JPEG
-            painted_obj = PaintedImage.from_wximage(image)
+            # Large images are scaled down to the layout width
+            max_width = self.max_width - 2*PaintedImage.MARGIN
+            bitmap = IMAGE_CACHE.GetBitmap(rich_text, max_width)
+            if bitmap is not None:
+                painted_obj = PaintedImage.from_bitmap(bitmap)
+                if IMAGE_CACHE.IsUpscaled(rich_text.key(), bitmap.GetWidth()):
+                    # Blurry until a larger level is decoded
+                    self.pending_images.append(rich_text.key())
+            else:
+                painted_obj = PaintedImage.placeholder(*IMAGE_CACHE.GetDisplaySize(rich_text, max_width))
+                if not IMAGE_CACHE.IsFailed(rich_text.key()):
+                    self.pending_images.append(rich_text.key())
             self.Append(idx, painted_obj, 0, 1)
 
 
+    def Align(self, alignment):
+        """ Moves the elements of each line for the alignment, without measuring again.
+            The spaces at the end of the lines are ignored, the last line of a justified paragraph and the lines
+            ending with a newline stay on the left.
+        """
+        if alignment in (None, Alignment.Left):
+            return
+        lines = [line for line in self.lines if line]
+        if alignment is Alignment.Justify:
+            lines = lines[:-1]
+        for line in lines:
+            last = line[-1]
+            if alignment is Alignment.Justify and type(last.layout) is PaintedRichtext and \
+                    last.layout.text.endswith(tuple(BREAK_CLASS_CHARS[BK])):
+                continue
+            free = self.max_width - (last.x + last.layout.width - last.layout.TrailingSpaceWidth())
+            if free <= 0:
+                continue
+            if alignment is Alignment.Justify:
+                self.JustifyLine(line, free)
+            else:
+                dx = free if alignment is Alignment.Right else free // 2
+                for elm in line:
+                    elm.x += dx
+        self.line_index = None
+
+    def JustifyLine(self, line, free):
+        """ Distributes 'free' pixels on the spaces of the line, except the spaces at the end """
+        spaces = []
+        for elm in line:
+            if type(elm.layout) is PaintedRichtext:
+                text = elm.layout.text
+                end = len(text.rstrip(HANGING_CHARS)) if elm is line[-1] else len(text)
+                spaces.extend((elm, m.start()) for m in SPACE_RE.finditer(text, 0, end))
+        if not spaces:
+            return
+        extra, remainder = divmod(free, len(spaces))
+        extras = defaultdict(list)
+        for i, (elm, offset) in enumerate(spaces):
+            extras[elm].append((offset, extra + (i < remainder)))
+        dx = 0
+        for elm in line:
+            elm.x += dx
+            if elm in extras:
+                elm.layout.Justify(extras[elm])
+                dx += sum(e for _, e in extras[elm])
+
     def Paint(self, dc, x, y):
-        for text in self.elements:
-            text.Paint(dc, x, y)
+        """ Draws the lines inside the clipping box of the dc.
+            The consecutive texts of a line with the same style are drawn together, with the font set once.
+            The selections and caret are drawn afterwards.
+        """
+        clip_x, clip_y, clip_width, clip_height = dc.GetClippingBox()
+        tops, bottoms, lines = self.GetLineIndex()
+        first, last = 0, len(lines)
+        if clip_height:
+            # An empty clipping box means no clipping
+            first = bisect_right(bottoms, clip_y - y)
+            last = bisect_left(tops, clip_y + clip_height - y)
+            PAINT_STATS.skipped += len(lines) - (last - first)
+        current_style = None
+        dc.SetTextForeground(wx.Colour("black"))
+        for xs, line in lines[first:last]:
+            i = 0
+            while i < len(line):
+                elm = line[i]
+                layout = elm.layout
+                if type(layout) is not PaintedRichtext:
+                    layout.Paint(dc, x + elm.x, y + elm.y)
+                    i += 1
+                    continue
+                style_key = (layout.style or DEFAULT_STYLE).key()
+                if style_key != current_style:
+                    dc.SetFont(GetFontCached(layout.style))
+                    PAINT_STATS.state_changes += 1
+                    current_style = style_key
+                # Merge the next texts of the same style that follow without a gap
+                j = i + 1
+                while (j < len(line) and type(line[j].layout) is PaintedRichtext and not layout.justified and
+                       not line[j].layout.justified and line[j].x == line[j-1].x + line[j-1].layout.width and
+                       (line[j].layout.style or DEFAULT_STYLE).key() == style_key):
+                    j += 1
+                if j == i + 1:
+                    layout.PaintText(dc, x + elm.x, y + elm.y)
+                else:
+                    dc.DrawText("".join(e.layout.text for e in line[i:j]), x + elm.x, y + elm.y)
+                    PAINT_STATS.draw_calls += 1
+                i = j
+        for xs, line in lines[first:last]:
+            for elm in line:
+                if type(elm.layout) is PaintedRichtext:
+                    elm.layout.PaintOverlay(dc, x + elm.x, y + elm.y)
         if debug:    
             dc.SetPen(wx.BLUE_PEN)
             dc.DrawRectangle(x+1, y+1, self.width-2, self.height-2)
@@ -335,16 +540,17 @@ class PaintedParagraph():
 
     def GetPaintedObject(self, richtext_idx=None, offset=None, before_split=False):
         """ Return a sub Element """
-        matching = {}
-        for line, painted_obj in self.elements_by_id[richtext_idx]:
-            if painted_obj.split_offset <= offset <= painted_obj.split_offset_end:
-                matching[offset == painted_obj.split_offset_end] = painted_obj
-        if len(matching) == 1:
-            return list(matching.values())[0]
-        elif len(matching) > 1:
-            return matching[before_split]
-        else:
-            raise Exception("Not found %s %s %s" % (richtext_idx, offset, self))
+        # Take the last element of richtext_idx starting at or before offset
+        i = bisect_right(self.element_keys, (richtext_idx, offset)) - 1
+        if i >= 0 and self.element_keys[i][0] == richtext_idx:
+            painted_obj = self.elements[i]
+            if offset <= painted_obj.split_offset_end:
+                # At a split, the previous element ends where this one starts
+                if (before_split and offset == painted_obj.split_offset and i > 0 and
+                    self.element_keys[i-1][0] == richtext_idx and self.elements[i-1].split_offset_end == offset):
+                    return self.elements[i-1]
+                return painted_obj
+        raise Exception("Not found %s %s %s" % (richtext_idx, offset, self))
 
     def IterateTexts(self, start_idx=None, end_idx=None, start_offset=None, end_offset=None):
         for elm in self.elements:
@@ -373,23 +579,151 @@ class PaintedParagraph():
             for t in elms[1:-1]:
                 t.SetSelected(selected, None, None)
 
+    def GetLineIndex(self):
+        """ Returns (tops, bottoms, lines) of the non empty lines, sorted by y.
+            Each line is (xs, elements) with the elements sorted by x.
+        """
+        if self.line_index is None:
+            tops, bottoms, lines = [], [], []
+            for line in self.lines:
+                if line:
+                    tops.append(line[0].y)
+                    bottoms.append(line[0].y + max(elm.layout.height for elm in line))
+                    lines.append(([elm.x for elm in line], line))
+            self.line_index = (tops, bottoms, lines)
+        return self.line_index
+
+    def GetLineHeights(self):
+        """ Heights of the non empty lines (e.g. for the pagination) """
+        tops, bottoms, lines = self.GetLineIndex()
+        return [bottom - top for top, bottom in zip(tops, bottoms)]
+
     def HitTest(self, x, y):
         """ Returns (richtext_id, offset, before_split) """
-        for elm in self.elements:
-            if elm.Contains(x,y):
-                return elm.HitTest(x, y)
-        # In the empty area at the end of a line: take the last matching of the line
-        for elm in reversed(self.elements):
-            if elm.ContainsY(y):
-                res = elm.HitTest(x, y)
-                return res
+        tops, bottoms, lines = self.GetLineIndex()
+        line_idx = bisect_right(tops, y) - 1
+        if line_idx < 0 or y > bottoms[line_idx]:
+            return None
+        xs, line = lines[line_idx]
+        # Left of the first element or in the empty area at the end of a line: take the closest element of the line
+        elm = line[max(bisect_right(xs, x) - 1, 0)]
+        return elm.HitTest(x, y)
+
+    @staticmethod
+    def IsLineStartFixed(elm):
+        """ True if the lines from elm do not depend on the previous lines (elm starting a line) """
+        return elm.split_offset > 0 or type(elm.layout) is PaintedImage
+
+    def Rewrap(self, paragraph):
+        """ Updates the layout after an edit inside one RichText: wraps again from the line before the edit
+            until a line starts at the same character as before, the next lines are then only moved.
+            Returns the rects that changed (relative to the paragraph), or None if the paragraph must be
+            laid out again with from_paragraph (other edits, alignments, optimal wrapping or pending images).
+            Nb: the moved lines are not measured again, if the measures are rounded differently at another
+            offset in the text, the lines can differ by a pixel from a new layout.
+        """
+        style = paragraph.style
+        if (self.optimal_wrap or self.pending_images or bool(style and style.optimal_wrap) or
+            (style and style.alignment not in (None, Alignment.Left))):
+            return None
+        sources = [layout_source(rich_text) for rich_text in paragraph.rich_texts]
+        if len(sources) != len(self.sources):
+            return None
+        changed = [i for i, (old, new) in enumerate(zip(self.sources, sources)) if old != new]
+        if not changed:
+            return []
+        idx = changed[0]
+        (old_text, old_style), (new_text, new_style) = self.sources[idx], sources[idx]
+        if len(changed) > 1 or type(paragraph.rich_texts[idx]) is not RichText or old_style != new_style:
+            return None
+        prefix = common_prefix_length(old_text, new_text)
+        suffix = common_suffix_length(old_text, new_text, min(len(old_text), len(new_text)) - prefix)
+        delta = len(new_text) - len(old_text)
+        edit_end = len(new_text) - suffix
+
+        # Start before the line of the edit: its beginning may now fit on the previous line.
+        # The first line of a text was wrapped for the space left after the previous text, so the wrapping
+        # can only start again at a line starting inside a text, with an image, or at the first line.
+        line_starts = list(itertools.accumulate(len(line) for line in self.lines))
+        elm_idx = bisect_right(self.element_keys, (idx, prefix)) - 1
+        line_idx = bisect_right(line_starts, elm_idx)
+        first_line = 0 if self.lines[0] else 1
+        if line_idx > first_line:
+            line_idx -= 1
+        while line_idx > first_line and not self.IsLineStartFixed(self.lines[line_idx][0]):
+            line_idx -= 1
+        first_elm = line_starts[line_idx] - len(self.lines[line_idx])
+        restart = self.lines[line_idx][0]
+        old_lines = self.lines[line_idx:]
+        old_height = self.height
+        old_starts = {(line[0].rich_text_idx, line[0].split_offset): i for i, line in enumerate(old_lines)
+                      if line and self.IsLineStartFixed(line[0])}
+        top = restart.y
+
+        def resync(rich_text_idx, offset):
+            """ Index in old_lines of the line starting at the same character, after the edit """
+            if rich_text_idx < idx or (rich_text_idx == idx and offset < edit_end):
+                return None
+            if rich_text_idx == idx:
+                offset -= delta
+            return old_starts.get((rich_text_idx, offset))
+
+        self.lines = self.lines[:line_idx] + [[]]
+        del self.elements[first_elm:]
+        del self.element_keys[first_elm:]
+        self.current_line = line_idx
+        self.insert_x = 0
+        self.insert_y = self.fullline_height = self.height = top
+        self.lastline_height = 0
+        self.line_index = None
+        self.break_after = False
+        self.resync, self.resynced = resync, None
+        try:
+            self.AppendFlow(restart.rich_text_idx, paragraph.rich_texts[restart.rich_text_idx], restart.split_offset)
+            for i in range(restart.rich_text_idx + 1, len(paragraph.rich_texts)):
+                if self.resynced is not None:
+                    break
+                self.AppendFlow(i, paragraph.rich_texts[i])
+        finally:
+            self.resync = None
+        self.sources = sources
+        if self.resynced is None:
+            return [wx.Rect(0, top, self.max_width, max(self.height, old_height) - top)]
+        # Move the old lines after the new ones
+        bottom = self.insert_y
+        dy = bottom - old_lines[self.resynced][0].y
+        self.lines.pop()
+        for line in old_lines[self.resynced:]:
+            for elm in line:
+                elm.y += dy
+                if elm.rich_text_idx == idx:
+                    elm.split_offset += delta
+                    elm.split_offset_end += delta
+                self.elements.append(elm)
+                self.element_keys.append((elm.rich_text_idx, elm.split_offset))
+            self.lines.append(line)
+        self.resynced = None
+        last = self.lines[-1]
+        self.current_line = len(self.lines) - 1
+        self.insert_y = self.fullline_height = last[0].y
+        self.lastline_height = max(elm.layout.height for elm in last)
+        self.insert_x = last[-1].x + last[-1].layout.width
+        self.height = old_height + dy
+        if dy:
+            bottom = max(self.height, old_height)
+        return [wx.Rect(0, top, self.max_width, bottom - top)]
 
     @classmethod
     def from_paragraph(cls, pos, paragraph,  max_width):
         # pos is mainly for debugging
         result = cls(pos, max_width)
+        style = paragraph.style
+        result.optimal_wrap = bool(style and style.optimal_wrap)
+        result.sources = [layout_source(rich_text) for rich_text in paragraph.rich_texts]
         for idx, rich_text in enumerate(paragraph.rich_texts):
             result.AppendFlow(idx, rich_text)
+        if style:
+            result.Align(style.alignment)
         return result
 
 
@@ -411,13 +745,68 @@ class CaretTimer(wx.EvtHandler):
         self.caret_timer.Start(500)
         self.OnBlink(self.blink_flag)
 
+    def Stop(self):
+        self.caret_timer.Stop()
+
 
 class PaintedParagraphDataModel():
     """ RowScroller that displays a collection of PaintedParagraph.
      """
-    def __init__(self, document, max_width=0):
+    def __init__(self, document, max_width=0, max_cached=512):
         self.document = document
         self.max_width = max_width
+        self.MODIFIED = event.Event()
+        self.INSERTED = event.Event()
+        self.DELETED = event.Event()
+        # Shifted by Inserted/Removed in O(log n) (not rebuilt)
+        self.waiting_images = RowStore(summed=False) # pos => {image key, ...} the images not decoded yet
+        self.layouts = RowStore(summed=False) # pos => PaintedParagraph
+        self.max_cached = max_cached
+        self.used_count = 0 # stamps PaintedParagraph.last_used, for the least recently used evictions
+        IMAGE_CACHE.DECODED.subscribe_weak(self.OnImageDecoded)
+
+    def Modified(self, pos, rects=None):
+        """ rects: the parts of the paragraph to repaint, all of it by default """
+        self.MODIFIED.fire(pos, rects)
+
+    def Edited(self, pos):
+        """ The paragraph at pos changed: wrap again only the lines that changed if possible """
+        layout = self.layouts.get(pos)
+        rects = None
+        if layout is not None:
+            rects = layout.Rewrap(self.document.elements[pos])
+            if rects is None:
+                self.layouts.pop(pos)
+            elif not rects:
+                return
+            else:
+                self.OnRewrapped(pos, layout)
+        self.Modified(pos, rects)
+
+    def OnRewrapped(self, pos, layout):
+        """ Called after the lines of the cached layout of pos were wrapped again (the new elements have no state) """
+
+    def Inserted(self, pos):
+        reindex = lambda p: p+1 if p >= pos else p
+        self.layouts.insert_rows(pos, 1)
+        self.waiting_images.insert_rows(pos, 1)
+        self.INSERTED.fire(pos, reindex)
+
+    def Removed(self, pos):
+        reindex = lambda p: p-1 if p > pos else p
+        self.layouts.remove_rows(pos, 1)
+        self.waiting_images.remove_rows(pos, 1)
+        self.DELETED.fire(pos, reindex)
+
+    def OnImageDecoded(self, key):
+        for pos, keys in self.waiting_images.items():
+            if key in keys:
+                keys.discard(key)
+                if not keys:
+                    self.waiting_images.pop(pos)
+                if pos < len(self.document.elements):
+                    self.layouts.pop(pos, None)
+                    self.Modified(pos)
 
     def GetApproximateCount(self):
         return len(self.document.elements)
@@ -443,10 +832,42 @@ class PaintedParagraphDataModel():
         return len(self.document.elements) -1
 
     def Get(self, pos):
+        self.used_count += 1
+        result = self.layouts.get(pos)
+        if result is not None:
+            result.last_used = self.used_count
+            return result
         row = self.document.elements[pos]
-        return PaintedParagraph.from_paragraph(pos, row, self.max_width)
+        result = PaintedParagraph.from_paragraph(pos, row, self.max_width)
+        result.last_used = self.used_count
+        self.layouts.set(pos, result)
+        if len(self.layouts) > self.max_cached:
+            self.Evict()
+        if result.pending_images:
+            keys = self.waiting_images.get(pos)
+            if keys is None:
+                keys = set()
+                self.waiting_images.set(pos, keys)
+            keys.update(result.pending_images)
+        return result
+
+    def Evict(self):
+        """ Drops the least recently used layouts, an eighth of max_cached at once """
+        items = sorted(self.layouts.items(), key=lambda item: item[1].last_used)
+        for pos, layout in items[:len(items) - self.max_cached + self.max_cached // 8]:
+            self.layouts.pop(pos)
+
+    def GetRowCached(self, pos):
+        """ The layout of pos if it is cached, else None """
+        return self.layouts.get(pos)
+
+    def IterateLayoutRows(self, start, end):
+        """ Yields (pos, layout) of the cached layouts from start to end (included) """
+        yield from self.layouts.items(start, end + 1)
 
     def SetMaxWidth(self, max_width):
+        if max_width != self.max_width:
+            self.layouts.clear()
         self.max_width = max_width
 
 
@@ -462,58 +883,70 @@ class PaintedParagraphDataModelWithCaret(PaintedParagraphDataModel):
         self.document.SELECTION_CHANGED.subscribe(self.OnSelectionChanged)
         self.caret_pos = None
         self.caret_visible = True # EnterFocus/LooseFocus
+        # The caret is not painted in the paragraphs: the control draws it over the screen
+        self.CARET_BLINKED = event.Event()
 
     def ShowCaret(self, show=True):
+        """ show=False hides the caret and pauses the blinking (focus lost, window hidden or inactive) """
         self.caret_visible = show
-        self.caret_timer.Reset()
+        if show:
+            self.caret_timer.Reset()
+        else:
+            self.caret_timer.Stop()
+            self.OnBlink(False)
 
     def OnCaretChanged(self, oldposition, position):
-        if oldposition:
-            self.caret.visible = False
-            self.Modified(oldposition.paragraph_id)
         self.caret = CaretLayout()
         if position:
             layout_paragraph = self.GetRowCached(position.paragraph_id)
             if layout_paragraph:
                 layout_paragraph.SetCaret(self.caret, position.richtext_id, position.offset, position.before_split)
-            # caret_timer.Reset will Call Modified(position.paragraph_id)
+        if self.caret_visible:
             self.caret_timer.Reset()
+        else:
+            self.OnBlink(False)
 
     def OnSelectionChanged(self, old_selection, selection):
         if selection is None:
             self.caret_start = None
 
+        # Only the paragraphs whose selected part changed are updated (e.g. the last one while dragging)
         modified = set()
-        if old_selection:
-            for pos, layout in self.IterateLayoutRows(old_selection.start.paragraph_id, old_selection.end.paragraph_id):
+        for changed in selection_changes(old_selection, selection):
+            for pos, layout in self.IterateLayoutRows(changed.start, changed.stop - 1):
+                old_range = old_selection and old_selection.ParagraphRange(pos)
+                new_range = selection and selection.ParagraphRange(pos)
+                if pos in modified or old_range == new_range:
+                    continue
                 layout.SetSelected(False, None, None)
+                if new_range is not None:
+                    layout.SetSelected(True, *new_range)
                 modified.add(pos)
-        if selection is not None:
-            for pos, layout in self.IterateLayoutRows(selection.start.paragraph_id, selection.end.paragraph_id):
-                start = selection.start if selection.start.paragraph_id == pos else None
-                end = selection.end if selection.end.paragraph_id == pos else None
-
-                layout.SetSelected(True, start, end)
-                modified.add(pos)
-        for p in modified:
+        for p in sorted(modified):
             self.Modified(p)
 
     def OnBlink(self, blink):
         self.caret.visible = blink and self.caret_visible
-        if self.document.caret_position:
-            self.Modified(self.document.caret_position.paragraph_id)
+        self.CARET_BLINKED.fire(self.caret.visible)
 
     def Get(self, pos):
         result = super().Get(pos)
+        self.ApplyState(pos, result)
+        return result
+
+    def OnRewrapped(self, pos, layout):
+        layout.SetSelected(False, None, None)
+        self.ApplyState(pos, layout)
+
+    def ApplyState(self, pos, layout):
+        """ Sets the caret and the selection of the document on the layout of pos """
         caret = self.document.GetCaretPosition()
         if caret and caret.paragraph_id == pos:
-            result.SetCaret(self.caret, caret.richtext_id, caret.offset, caret.before_split)
+            layout.SetCaret(self.caret, caret.richtext_id, caret.offset, caret.before_split)
         selection = self.document.GetSelection()
-        if selection and selection.ContainsParagraph(pos):
-            start = selection.start if selection.start.paragraph_id == pos else None
-            end = selection.end if selection.end.paragraph_id == pos else None
-            result.SetSelected(self.caret, start, end)
-        return result
+        selected = selection and selection.ParagraphRange(pos)
+        if selected is not None:
+            layout.SetSelected(True, *selected)
 
 RICHTEXT_CTRL_DOWN = 1
 RICHTEXT_SHIFT_DOWN = 2
@@ -558,6 +991,11 @@ class CustomRichTextControl(RowScroller):
         self.dragging = False
         self.caret_start = None
         self.do_stack = []
+        self.paginator = None
+        self.caret_drawn = None # Rect of the caret drawn over the screen
+        self.datamodel.CARET_BLINKED.subscribe(self.OnCaretBlinked)
+        self.Bind(wx.EVT_SHOW, self.OnShow)
+        wx.GetTopLevelParent(self).Bind(wx.EVT_ACTIVATE, self.OnActivate)
 
     def OnSetFocus(self, event):
         self.datamodel.ShowCaret()
@@ -565,6 +1003,35 @@ class CustomRichTextControl(RowScroller):
     def OnKillFocus(self, event):
         self.datamodel.ShowCaret(False)
 
+    def OnShow(self, event):
+        event.Skip()
+        self.datamodel.ShowCaret(event.IsShown() and self.HasFocus())
+
+    def OnActivate(self, event):
+        event.Skip()
+        self.datamodel.ShowCaret(event.GetActive() and self.HasFocus())
+
+    def OnCaretBlinked(self, visible):
+        """ Blinking doesn't paint the rows: the caret rect is restored from the back buffer, or drawn again """
+        if self.dc_back is None:
+            return
+        if self.caret_drawn is not None:
+            rect, self.caret_drawn = self.caret_drawn, None
+            # The caret drawn at another place shows an input (e.g. an arrow key), not a blink
+            generation = self.latency.Damaged() if visible and rect != self.GetCaretRect() else None
+            self.BlitToScreen(rect, generation)
+        elif visible:
+            self.PaintOverlay(wx.ClientDC(self), self.GetClientRect())
+
+    def PaintOverlay(self, dc, rect):
+        """ Draws the caret at its current position (a scroll may have moved it, even outside of rect) """
+        if not self.datamodel.caret.visible:
+            return
+        caret_rect = self.GetCaretRect()
+        if caret_rect is not None:
+            self.datamodel.caret.Paint(dc, caret_rect)
+            self.caret_drawn = caret_rect
+
     def CaretHitTest(self, x, y):
         """ return a CaretPosition from an x,y"""
         result = self.HitTest(x, y)
@@ -643,11 +1110,14 @@ class CustomRichTextControl(RowScroller):
         caret = self.document.GetCaretPosition()
         if not caret:
             return
+        y = self.GetLayoutY(caret.paragraph_id)
+        if y is None:
+            return
         p = self.GetRowCached(caret.paragraph_id)
         if not p:
             return
         caret_rect = p.GetCaretRect(caret.richtext_id, caret.offset, caret.before_split)
-        caret_rect.Offset(self.margin, self.GetLayoutY(caret.paragraph_id))
+        caret_rect.Offset(self.margin, y)
         return caret_rect
 
     def ScrollIntoCaretView(self):
@@ -799,21 +1269,25 @@ class CustomRichTextControl(RowScroller):
         self.DoActions(actions)
         self.ScrollIntoCaretView()
 
+    def SetPaginator(self, paginator):
+        """ Keeps the page index of a pagination.Paginator (e.g. of a print preview) up to date with the edits """
+        self.paginator = paginator
+
     def RedrawChanges(self, changes):
+        if self.paginator is not None:
+            self.paginator.ApplyChanges(changes)
         for change, idx in changes:
             if change is ParagraphChange.Modified:
-                self.Modified(idx)
+                self.datamodel.Edited(idx)
             elif change is ParagraphChange.Inserted:
-                self.Inserted(idx)
+                self.datamodel.Inserted(idx)
             elif change is ParagraphChange.Removed:
-                self.Removed(idx)
+                self.datamodel.Removed(idx)
 
     def DoActions(self, actions):
         self.do_stack.append(actions)
         for action in actions:
-            res = action.do(self.document)
-            print (res)
-            self.RedrawChanges(res)
+            self.RedrawChanges(action.do(self.document))
 
     def Do(self, *actions):
         self.current_actions.extend(actions)
@@ -965,6 +1439,7 @@ class CustomRichTextControl(RowScroller):
     # Shift+Enter vs Enter
 
     def OnLeftDown(self, event):
+        self.latency.Input("click")
         caret = self.CaretHitTest(*event.GetPosition())
         if caret:
             self.document.SetCaret(caret)
@@ -974,6 +1449,7 @@ class CustomRichTextControl(RowScroller):
 
     def OnMouseMove(self, event):
         if self.dragging:
+            self.latency.Input("drag")
             caret = self.CaretHitTest(*event.GetPosition())
             if self.caret_start and caret and self.caret_start != caret:
                 selection = Selection(self.caret_start, caret)
@@ -0,0 +1,188 @@
+""" A sparse mapping of row positions to values (e.g. the measured row heights), where inserting or removing rows
+    shifts the positions of all the following rows in O(log n), without rebuilding anything.
+
+    It is a treap (a binary search tree balanced with random priorities) ordered by position.
+    Shifting keys is a lazy 'delta' on a subtree, applied to the children only when they are visited.
+    Each node also keeps the count and the sum of the values of its subtree (without the sum if summed=False,
+    for the values that can't be added, e.g. the layouts of the rows).
+"""
+import random
+
+
+class RowNode():
+    __slots__ = ("key", "value", "priority", "left", "right", "count", "total", "delta")
+
+    def __init__(self, key, value, summed=True):
+        self.key = key
+        self.value = value
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.count = 1
+        self.total = value if summed else None
+        self.delta = 0 # to add to the keys of the children
+
+
+def shift(node, delta):
+    if node is not None:
+        node.key += delta
+        node.delta += delta
+
+
+def push(node):
+    if node.delta:
+        shift(node.left, node.delta)
+        shift(node.right, node.delta)
+        node.delta = 0
+
+
+def update(node):
+    summed = node.total is not None
+    node.count = 1
+    node.total = node.value if summed else None
+    for child in (node.left, node.right):
+        if child is not None:
+            node.count += child.count
+            if summed:
+                node.total += child.total
+
+
+def split(node, key):
+    """ Returns (the nodes with keys < key, the nodes with keys >= key) """
+    if node is None:
+        return (None, None)
+    push(node)
+    if node.key < key:
+        left, right = split(node.right, key)
+        node.right = left
+        update(node)
+        return (node, right)
+    left, right = split(node.left, key)
+    node.left = right
+    update(node)
+    return (left, node)
+
+
+def merge(left, right):
+    """ All the keys of left must be smaller than the keys of right """
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        push(left)
+        left.right = merge(left.right, right)
+        update(left)
+        return left
+    push(right)
+    right.left = merge(left, right.left)
+    update(right)
+    return right
+
+
+def iterate(node):
+    """ Yields the nodes in key order """
+    stack = []
+    while stack or node is not None:
+        if node is not None:
+            push(node)
+            stack.append(node)
+            node = node.left
+        else:
+            node = stack.pop()
+            yield node
+            node = node.right
+
+
+class RowStore():
+    """ {row position: value}, the values must support + (e.g. heights) unless summed=False """
+    def __init__(self, items=(), summed=True):
+        self.root = None
+        self.summed = summed
+        for key, value in items:
+            self.set(key, value)
+
+    def __len__(self):
+        return self.root.count if self.root is not None else 0
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def find(self, key):
+        node = self.root
+        while node is not None:
+            push(node)
+            if key == node.key:
+                return node
+            node = node.left if key < node.key else node.right
+        return None
+
+    def get(self, key, default=None):
+        node = self.find(key)
+        return node.value if node is not None else default
+
+    def set(self, key, value):
+        left, right = split(self.root, key)
+        middle, right = split(right, key + 1)
+        self.root = merge(merge(left, RowNode(key, value, self.summed)), right)
+
+    def pop(self, key, *default):
+        left, right = split(self.root, key)
+        middle, right = split(right, key + 1)
+        self.root = merge(left, right)
+        if middle is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return middle.value
+
+    def clear(self):
+        self.root = None
+
+    def insert_rows(self, pos, count=1, values=None):
+        """ Inserts count rows at pos: the keys >= pos are shifted by count.
+            values: the values of the inserted rows (None for the rows without values)
+        """
+        left, right = split(self.root, pos)
+        shift(right, count)
+        inserted = None
+        for i, value in enumerate(values or ()):
+            if value is not None:
+                inserted = merge(inserted, RowNode(pos + i, value, self.summed))
+        self.root = merge(merge(left, inserted), right)
+
+    def remove_rows(self, pos, count=1):
+        """ Removes the rows pos to pos+count-1: the following keys are shifted by -count.
+            Returns the removed [(key, value), ...]
+        """
+        left, right = split(self.root, pos)
+        removed, right = split(right, pos + count)
+        shift(right, -count)
+        self.root = merge(left, right)
+        return [(node.key, node.value) for node in iterate(removed)]
+
+    def total(self, start=None, end=None):
+        """ Sum of the values of the keys from start to end (excluded), of all the keys by default """
+        if start is None and end is None:
+            return self.root.total if self.root is not None else 0
+        left, right = split(self.root, start if start is not None else float("-inf"))
+        middle, right = split(right, end if end is not None else float("inf"))
+        result = middle.total if middle is not None else 0
+        self.root = merge(merge(left, middle), right)
+        return result
+
+    def keys(self):
+        return [node.key for node in iterate(self.root)]
+
+    def values(self):
+        return [node.value for node in iterate(self.root)]
+
+    def items(self, start=None, end=None):
+        """ [(key, value), ...] of the keys from start to end (excluded), of all the keys by default """
+        if start is None and end is None:
+            return [(node.key, node.value) for node in iterate(self.root)]
+        left, right = split(self.root, start if start is not None else float("-inf"))
+        middle, right = split(right, end if end is not None else float("inf"))
+        result = [(node.key, node.value) for node in iterate(middle)]
+        self.root = merge(merge(left, middle), right)
+        return result
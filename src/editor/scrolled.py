@@ -1,12 +1,14 @@
 import wx
 from wx import MemoryDC, WXK_PAGEDOWN, WXK_PAGEUP, WXK_UP, WXK_DOWN
 from _collections import deque
+import weakref
 import random
 import time
 from enum import Enum
 import math
 from editor.event import Event
-from editor.util import first
+from editor.util import PAINT_STATS, LatencyTracker
+from editor.rowstore import RowStore
 from wx.lib.newevent import NewEvent
 
 
@@ -73,29 +75,360 @@ RowScrollerScrolledEvent, EVT_ROWSCROLLER_SCROLLED = NewEvent()
 RowScrollerDisplayChanged, EVT_ROWSCROLLER_DISPLAY_CHANGED = NewEvent()
 
 
+class DamageRegion():
+    """ The rects to repaint at the next frame. Overlapping or touching rects are merged, and all
+        the rects are merged in their bounding box above max_rects.
+    """
+    def __init__(self, max_rects=8):
+        self.rects = []
+        self.max_rects = max_rects
+
+    def __bool__(self):
+        return bool(self.rects)
+
+    def Add(self, rect):
+        if rect.IsEmpty():
+            return
+        rect = wx.Rect(rect)
+        i = 0
+        while i < len(self.rects):
+            if wx.Rect(self.rects[i]).Inflate(1, 1).Intersects(rect):
+                rect = rect.Union(self.rects.pop(i))
+                i = 0
+            else:
+                i += 1
+        self.rects.append(rect)
+        if len(self.rects) > self.max_rects:
+            bounding_box = self.rects[0]
+            for r in self.rects[1:]:
+                bounding_box = bounding_box.Union(r)
+            self.rects = [bounding_box]
+
+    def Pop(self):
+        rects, self.rects = self.rects, []
+        return rects
+
+
+class RowBitmapCache():
+    """ Rows rendered once in offscreen bitmaps, keyed by rowpos and width.
+        Invalidate drops the bitmaps of a row. Above max_bytes, the rows farthest from the
+        displayed rows are evicted (rowpos are compared as numbers). Rows taller than max_height are not cached.
+    """
+    def __init__(self, max_bytes=64*1024*1024, max_height=4096):
+        self.max_bytes = max_bytes
+        self.max_height = max_height
+        self.bitmaps = {} # rowpos => {width: wx.Bitmap}
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def Get(self, rowpos, row, width, margin, background):
+        """ The bitmap of the row (painted at x=margin), None if it is too tall """
+        if row.height > self.max_height or row.height <= 0 or width <= 0:
+            return None
+        bitmap = self.bitmaps.get(rowpos, {}).get(width)
+        if bitmap is not None:
+            self.hits += 1
+            return bitmap
+        self.misses += 1
+        bitmap = wx.Bitmap(width, row.height)
+        dc = wx.MemoryDC(bitmap)
+        dc.SetBackground(wx.Brush(background))
+        dc.Clear()
+        row.Paint(dc, margin, 0)
+        dc.SelectObject(wx.NullBitmap)
+        self.bitmaps.setdefault(rowpos, {})[width] = bitmap
+        self.size_bytes += bitmap_bytes(bitmap)
+        return bitmap
+
+    def Invalidate(self, rowpos):
+        for bitmap in self.bitmaps.pop(rowpos, {}).values():
+            self.size_bytes -= bitmap_bytes(bitmap)
+
+    def Reindex(self, reindex_func):
+        """ Moves the bitmaps to the new positions of their rows after an insert or a remove """
+        self.bitmaps = {reindex_func(rowpos): bitmaps for rowpos, bitmaps in self.bitmaps.items()}
+
+    def Trim(self, first_pos, last_pos):
+        """ Evicts the rows farthest from first_pos..last_pos (the displayed rows) until under max_bytes """
+        if self.size_bytes <= self.max_bytes:
+            return
+        def distance(rowpos):
+            return max(first_pos - rowpos, rowpos - last_pos, 0)
+        for rowpos in sorted(self.bitmaps, key=distance, reverse=True):
+            if self.size_bytes <= self.max_bytes:
+                break
+            self.Invalidate(rowpos)
+            self.evictions += 1
+
+    def Clear(self):
+        self.bitmaps.clear()
+        self.size_bytes = 0
+
+    def Stats(self):
+        return {"rows": len(self.bitmaps), "bytes": self.size_bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+def bitmap_bytes(bitmap):
+    return bitmap.GetWidth() * bitmap.GetHeight() * 4
+
+
 class RowHeigths():
-    def __init__(self):
-        self.row_heights = {}
-        
+    """ Heights of the rows laid out at the current width, and a running histogram of the row heights
+        per bucket of 'bucket_width' pixels of width, kept across resizes.
+        After a resize, the estimate comes from the closest bucket without laying out any row.
+        to_dict/from_dict save the histograms, e.g. to estimate the height of a document when it is opened again.
+    """
+    def __init__(self, bucket_width=50, max_samples=10000, default_height=20):
+        self.bucket_width = bucket_width
+        self.max_samples = max_samples
+        self.default_height = default_height
+        self.row_heights = RowStore() # pos => height, shifted in O(log n) by insert_rows/remove_rows
+        self.width = 0
+        self.buckets = {} # width // bucket_width => {height: count}
+
     def reset(self):
-        self.row_heights = {}
+        """ Forgets the rows, but not the histograms """
+        self.row_heights.clear()
+
+    def set_width(self, width):
+        """ The heights of the rows are only valid for one width """
+        if width // self.bucket_width != self.width // self.bucket_width:
+            self.row_heights.clear()
+        self.width = width
 
     def add(self, pos, height):
-        self.row_heights[pos] = height
-        
+        previous = self.row_heights.get(pos)
+        if previous == height:
+            return
+        histogram = self.buckets.setdefault(self.width // self.bucket_width, {})
+        if previous is not None:
+            self.discard_sample(histogram, previous)
+        self.row_heights.set(pos, height)
+        histogram[height] = histogram.get(height, 0) + 1
+        if sum(histogram.values()) > self.max_samples:
+            # Running histogram: the old samples weigh less and less
+            for h in list(histogram):
+                histogram[h] //= 2
+                if not histogram[h]:
+                    del histogram[h]
+
     def remove(self, pos):
-        del self.row_heights[pos]
-
-    def estimate(self):    
-        return sum(self.row_heights.values()) / len(self.row_heights)
- 
-    def reindex(self, reindex_func):   
-        row_heights = {}
-        for k in self.row_heights:
-            row_heights[reindex_func(k)] = self.row_heights[k]
-        self.row_heights = row_heights
- 
-    
+        height = self.row_heights.pop(pos)
+        self.discard_sample(self.buckets.get(self.width // self.bucket_width, {}), height)
+
+    @staticmethod
+    def discard_sample(histogram, height):
+        count = histogram.get(height, 0) - 1
+        if count > 0:
+            histogram[height] = count
+        else:
+            histogram.pop(height, None)
+
+    def has_samples(self):
+        return any(self.buckets.values())
+
+    def closest_histogram(self):
+        bucket = self.width // self.bucket_width
+        buckets = [b for b, histogram in self.buckets.items() if histogram]
+        if not buckets:
+            return None
+        return self.buckets[min(buckets, key=lambda b: (abs(b - bucket), b))]
+
+    def estimate(self):
+        histogram = self.closest_histogram()
+        if histogram is None:
+            return self.default_height
+        return sum(h * count for h, count in histogram.items()) / sum(histogram.values())
+
+    def insert_rows(self, pos, count=1):
+        self.row_heights.insert_rows(pos, count)
+
+    def remove_rows(self, pos, count=1):
+        histogram = self.buckets.get(self.width // self.bucket_width, {})
+        for _, height in self.row_heights.remove_rows(pos, count):
+            self.discard_sample(histogram, height)
+
+    def reindex(self, reindex_func):
+        """ Moves the rows with any function (insert_rows and remove_rows are faster) """
+        self.row_heights = RowStore((reindex_func(k), height) for k, height in self.row_heights.items())
+
+    def to_dict(self):
+        """ The histograms, as a json serializable dict """
+        return {"bucket_width": self.bucket_width,
+                "buckets": {str(b): {str(h): count for h, count in histogram.items()}
+                            for b, histogram in self.buckets.items() if histogram}}
+
+    @classmethod
+    def from_dict(cls, data, **kwargs):
+        result = cls(bucket_width=data["bucket_width"], **kwargs)
+        result.buckets = {int(b): {int(h): count for h, count in histogram.items()}
+                          for b, histogram in data["buckets"].items()}
+        return result
+
+
+class ScrollScheduler(wx.EvtHandler):
+    """ Coalesces the scroll requests (wheel, scrollbar, keys) and applies them once per frame, on a timer.
+        The relative distances are added up, an absolute position replaces what is pending.
+        Kinetic scrolling: a distance becomes a velocity, slowed down by 'friction' at each frame,
+        so that the same distance is covered smoothly.
+    """
+    def __init__(self, scroller, interval=16, friction=0.85):
+        super().__init__()
+        self.scroller = scroller
+        self.interval = interval # ms
+        self.friction = friction
+        self.kinetic = False
+        self.delta = 0
+        self.target = None
+        self.velocity = 0
+        self.remainder = 0
+        self.last_tick = None
+        self.frame_times = deque(maxlen=240)
+        self.frames = 0
+        self.dropped = 0
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnTick, self.timer)
+
+    def ScrollBy(self, distance, kinetic=False):
+        if kinetic:
+            # The sum of velocity * friction**n is distance
+            self.velocity += distance * (1 - self.friction)
+        else:
+            self.delta += distance
+        self.Schedule()
+
+    def ScrollTo(self, pos):
+        self.target = pos
+        self.delta = self.velocity = self.remainder = 0
+        self.Schedule()
+
+    def Schedule(self):
+        if not self.timer.IsRunning():
+            self.last_tick = None
+            self.timer.Start(self.interval)
+
+    def Cancel(self):
+        self.timer.Stop()
+        self.target = None
+        self.delta = self.velocity = self.remainder = 0
+
+    def OnTick(self, event):
+        now = time.perf_counter()
+        if self.last_tick is not None:
+            # Ticks missed because the previous frame (or something else) took too long
+            self.dropped += max(round((now - self.last_tick) * 1000 / self.interval) - 1, 0)
+        self.last_tick = now
+        target, self.target = self.target, None
+        distance = self.delta + self.velocity + self.remainder
+        self.delta = 0
+        step = int(distance)
+        self.remainder = distance - step
+        self.velocity *= self.friction
+        if abs(self.velocity) < 0.5:
+            self.velocity = 0
+        if target is not None:
+            self.scroller.ScrollTo(target)
+        if step:
+            current_pos = self.scroller.current_pos
+            self.scroller.Scroll(step)
+            if self.scroller.current_pos == current_pos:
+                # At the top or bottom: stop the kinetic scrolling
+                self.velocity = self.remainder = 0
+        if target is not None or step:
+            self.frames += 1
+            self.frame_times.append(now)
+        if not self.velocity and not self.delta and self.target is None:
+            self.timer.Stop()
+            self.remainder = 0
+
+    def Stats(self):
+        now = time.perf_counter()
+        fps = sum(1 for t in self.frame_times if now - t <= 1)
+        return {"frames": self.frames, "dropped": self.dropped, "fps": fps}
+
+
+class RowPrefetcher():
+    """ Lays out the rows around the viewport when the application is idle, so that scrolling finds them in
+        the cache of the data model (e.g. PaintedParagraphDataModel.layouts).
+        'screens' screens are prefetched above and below, the rows closest to the viewport first.
+        Each idle event works at most 'budget' seconds, and stops as soon as an event is pending:
+        the prefetch starts again from the new viewport at the next idle event.
+    """
+    def __init__(self, scroller, screens=2, budget=0.005, max_tracked=10000):
+        self.scroller = scroller
+        self.screens = screens
+        self.budget = budget
+        self.max_tracked = max_tracked
+        self.enabled = True
+        self.viewport = None
+        self.cursors = {} # direction (1: below, -1: above) => [next rowpos, distance to the viewport]
+        self.prefetched = weakref.WeakValueDictionary() # rowpos => row laid out, gone when the data model evicts it
+        self.prefetches = 0
+        self.hits = 0
+        self.misses = 0
+
+    def Cancel(self):
+        self.viewport = None
+        self.cursors = {}
+
+    def OnIdle(self, event):
+        event.Skip()
+        scroller = self.scroller
+        if not self.enabled or not scroller.displayed_rows:
+            return
+        first_row, last_row = scroller.displayed_rows[0], scroller.displayed_rows[-1]
+        viewport = (first_row.rowpos, first_row.y, last_row.rowpos, scroller.inner_height)
+        if viewport != self.viewport:
+            self.viewport = viewport
+            self.cursors = {1: [scroller.datamodel.GetNextPos(last_row.rowpos), max(last_row.end_y - scroller.inner_height, 0)],
+                            -1: [scroller.datamodel.GetPrevPos(first_row.rowpos), max(-first_row.y, 0)]}
+            if len(self.prefetched) > self.max_tracked:
+                self.prefetched.clear()
+        limit = self.screens * scroller.inner_height
+        app = wx.GetApp()
+        deadline = time.perf_counter() + self.budget
+        while time.perf_counter() < deadline:
+            if app is not None and app.Pending():
+                # Input arrived: let it be processed first
+                self.Cancel()
+                return
+            candidates = [(distance, direction) for direction, (rowpos, distance) in self.cursors.items()
+                          if rowpos is not None and distance < limit]
+            if not candidates:
+                return
+            distance, direction = min(candidates)
+            rowpos = self.cursors[direction][0]
+            row = scroller.GetRowCached(rowpos)
+            self.prefetched[rowpos] = row
+            self.prefetches += 1
+            if direction > 0:
+                next_pos = scroller.datamodel.GetNextPos(rowpos)
+            else:
+                next_pos = scroller.datamodel.GetPrevPos(rowpos)
+            self.cursors[direction] = [next_pos, distance + row.height]
+        event.RequestMore()
+
+    def Viewed(self, rowpositions):
+        """ rowpositions scrolled into view: hits if the displayed rows are the ones prefetched
+            (not laid out again because the data model evicted them in the meantime)
+        """
+        for rowpos in rowpositions:
+            row = self.prefetched.pop(rowpos, None)
+            displayed = self.scroller.rows_by_pos.get(rowpos)
+            if row is not None and displayed is not None and displayed.row is row:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def Stats(self):
+        viewed = self.hits + self.misses
+        return {"prefetches": self.prefetches, "hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / viewed if viewed else 0}
+
+
 class RowScroller(wx.Window):
     """ A VScrolledWindow that allows for pixel size scrolling
     """
@@ -106,6 +439,7 @@ class RowScroller(wx.Window):
         self.Bind(wx.EVT_CHAR,self.__OnChar)
         self.Bind(wx.EVT_SCROLLWIN, self.OnScroll)
         self.Bind(wx.EVT_MOUSEWHEEL, self.OnMouseWheel)
+        self.Bind(wx.EVT_PAINT, self.OnPaint)
         self.line_size = 16 # Scroll this many pixels each time
         
         self.pixels_hidden_first_row = 0
@@ -124,16 +458,56 @@ class RowScroller(wx.Window):
         
         # New
         self.displayed_rows = deque()
+        self.rows_by_pos = {} # rowpos => DisplayedRow, in sync with displayed_rows
         self.heights = RowHeigths()
+        self.dc_back = None
+        self.damage = DamageRegion()
+        self.flush_pending = False
+        self.row_cache = None
+        self.scheduler = ScrollScheduler(self)
+        self.prefetcher = RowPrefetcher(self)
+        self.Bind(wx.EVT_IDLE, self.prefetcher.OnIdle)
+        self.latency = LatencyTracker()
+        self.damage_generation = 0
+        self.latency_overlay = False
+        self.Bind(wx.EVT_KEY_DOWN, self.OnKeyDownLatency)
         
 
+    def ShowLatencyOverlay(self, show=True):
+        """ Debug overlay with the input to screen latencies (see self.latency) """
+        self.latency_overlay = show
+        self.AddDamage(self.GetClientRect())
+
+    def OnKeyDownLatency(self, event):
+        if event.GetKeyCode() not in (wx.WXK_SHIFT, wx.WXK_CONTROL, wx.WXK_ALT, wx.WXK_RAW_CONTROL):
+            self.latency.Input("key")
+        event.Skip()
+
+    def EnablePrefetch(self, enable=True, screens=2):
+        """ Lays out 'screens' screens above and below the viewport while the application is idle """
+        self.prefetcher.enabled = enable
+        self.prefetcher.screens = screens
+        self.prefetcher.Cancel()
+
+    def EnableKineticScrolling(self, enable=True):
+        """ The mouse wheel scrolls smoothly, over several frames """
+        self.scheduler.kinetic = enable
+
+    def EnableRowCache(self, enable=True, max_bytes=64*1024*1024):
+        """ Paints the rows from a RowBitmapCache: scrolling only draws bitmaps """
+        self.row_cache = RowBitmapCache(max_bytes) if enable else None
+
     def SetFixedRow(self, rowpos):
         """ The current row is the row that stays fixed when rows are inserted, or removed"""
         self.fixed_row = rowpos
-        self.PaintRect(self.GetClientRect())
+        self.AddDamage(self.GetClientRect())
 
     def GetFixedRow(self):
-        return first(self.displayed_rows, lambda e: e.rowpos == self.fixed_row)
+        return self.rows_by_pos.get(self.fixed_row)
+
+    def GetDisplayedRow(self, rowpos):
+        """ The DisplayedRow of rowpos, None if it is not displayed """
+        return self.rows_by_pos.get(rowpos)
         
     def GetRowCached(self, row_id):
         result = self.datamodel.Get(row_id)
@@ -145,85 +519,174 @@ class RowScroller(wx.Window):
             self.fixed_row = reindex_func(self.fixed_row)
         for d in self.displayed_rows:
             d.rowpos = reindex_func(d.rowpos)          
-        self.heights.reindex(reindex_func)
+        self.rows_by_pos = {d.rowpos: d for d in self.displayed_rows}
 
     def OnInserted(self, insert_pos, reindex_func):
+        if self.row_cache:
+            self.row_cache.Reindex(reindex_func)
+        self.heights.insert_rows(insert_pos)
         self.ReindexDisplayedRows(reindex_func)      
         fixed_row = self.GetFixedRow()
         if self.fixed_row:
             self.ScrollToLayout(self.fixed_row, fixed_row.y)
         else:
             self.ScrollToLayout(self.displayed_rows[0].rowpos, self.displayed_rows[0].y)
-        self.PaintRect(self.GetClientRect())
+        self.AddDamage(self.GetClientRect())
         wx.PostEvent(self, RowScrollerDisplayChanged())     
             
     def OnRemoved(self, pos, reindex_func):
+        if self.row_cache:
+            self.row_cache.Invalidate(pos)
+            self.row_cache.Reindex(reindex_func)
         if self.fixed_row == pos:
             self.fixed_row = None 
         fixed_row = self.GetFixedRow()
+        self.heights.remove_rows(pos)
         self.ReindexDisplayedRows(reindex_func)      
         if self.fixed_row:
             self.ScrollToLayout(self.fixed_row, fixed_row.y)
         else:
             self.ScrollToLayout(self.displayed_rows[0].rowpos, self.displayed_rows[0].y)
-        self.PaintRect(self.GetClientRect())
+        self.AddDamage(self.GetClientRect())
 
-    def OnModified(self, rowpos):
-        disprow = first(self.displayed_rows, lambda e: e.rowpos == rowpos)
+    def OnModified(self, rowpos, rects=None):
+        """ rects: the parts of the row that changed (relative to the row), all the row by default """
+        if self.row_cache:
+            self.row_cache.Invalidate(rowpos)
+        disprow = self.rows_by_pos.get(rowpos)
         if not disprow:
             return
         row = self.GetRowCached(rowpos)
+        disprow.row = row
         if row.height != disprow.height():
             fixed_row = self.GetFixedRow()
             if self.fixed_row:
                 self.ScrollToLayout(self.fixed_row, fixed_row.y)
             else:
                 self.ScrollToLayout(self.displayed_rows[0].rowpos, self.displayed_rows[0].y)
-            self.PaintRect(self.GetClientRect())
+            self.AddDamage(self.GetClientRect())
+        elif rects is None:
+            self.AddDamage(self.GetLayoutRect(rowpos))
         else:
-            self.RepaintRow(rowpos)
-            self.BlitToScreen(self.GetLayoutRect(rowpos))
-    
-    def GetLayoutRect(self, rowpos):
-        disprow = first(self.displayed_rows, lambda e: e.rowpos == rowpos)
-        result = wx.Rect(0, disprow.y, self.client_width, disprow.end_y) 
+            for rect in rects:
+                self.AddDamage(wx.Rect(rect.x + self.margin, rect.y + disprow.y, rect.width, rect.height))
 
-    def PaintRow(self, dc, row, start_y, end_y):
-        dc.SetClippingRegion (wx.Rect((self.margin, start_y , self.client_width, end_y - start_y)))
-        dc.Clear()
-        row.Paint(dc, self.margin, start_y)
+    def GetLayoutRect(self, rowpos):
+        """ Rect of a displayed row in the window """
+        disprow = self.rows_by_pos.get(rowpos)
+        return wx.Rect(0, disprow.y, self.client_width, disprow.height())
+
+    def GetLayoutY(self, rowpos):
+        """ y of a displayed row in the window, None if it is not displayed """
+        disprow = self.rows_by_pos.get(rowpos)
+        return disprow and disprow.y
+
+    def AddDamage(self, rect):
+        """ Repaints rect (in the window) at the next frame, together with the other damaged rects """
+        if self.dc_back is None:
+            return
+        self.damage.Add(rect.Intersect(self.GetClientRect()))
+        self.damage_generation = self.latency.Damaged()
+        if self.damage and not self.flush_pending:
+            self.flush_pending = True
+            wx.CallAfter(self.FlushDamage)
+
+    def FlushDamage(self):
+        self.flush_pending = False
+        for rect in self.damage.Pop():
+            self.PaintRect(rect, end_frame=False, generation=self.damage_generation)
+        PAINT_STATS.EndFrame()
+
+    def PaintRow(self, dc, row, start_y, end_y, rect=None, rowpos=None):
+        """ rect: only paint this part of the row
+            rowpos: to use the row cache
+        """
+        clip = wx.Rect(self.margin, start_y , self.client_width, end_y - start_y)
+        if rect is not None:
+            clip = clip.Intersect(rect)
+        dc.SetClippingRegion(clip)
+        bitmap = None
+        if self.row_cache and rowpos is not None:
+            bitmap = self.row_cache.Get(rowpos, row, self.client_width, self.margin, self.GetBackgroundColour())
+        if bitmap is not None:
+            dc.DrawBitmap(bitmap, 0, start_y)
+        else:
+            dc.Clear()
+            row.Paint(dc, self.margin, start_y)
         dc.DestroyClippingRegion()
 
-    def RepaintRow(self, rowpos):
-        d = first(self.displayed_rows, lambda e: e.rowpos == rowpos)
-        #rowpos, row, start_y, next_y = self.displayed_rows(rowpos)
-        self.dc_back.SetClippingRegion(wx.Rect(self.margin, d.y , self.client_width, d.height()))
-        self.dc_back.Clear()
-        d.row.Paint(self.dc_back, self.margin, d.y)
-        self.dc_back.DestroyClippingRegion()
-
-    def BlitToScreen(self, rect):
-        # TODO: Remove this..
-        rect = self.GetClientRect()
+    def BlitToScreen(self, rect, generation=None):
+        """ generation: of the damage repainted in rect (see LatencyTracker), None if nothing was repainted """
         dc = wx.ClientDC(self)
         dc.Blit(rect.x, rect.y, rect.width, rect.height, self.dc_back, rect.x, rect.y)
-
-    def PaintRect(self, rect, refresh=True):
+        self.PaintOverlay(dc, rect)
+        if generation is not None:
+            self.latency.Blitted(generation)
+        if self.latency_overlay:
+            self.PaintLatencyOverlay(dc)
+
+    def PaintOverlay(self, dc, rect):
+        """ Draws on the screen what is not in the back buffer (e.g. a caret), after rect was blitted """
+        pass
+
+    def OnPaint(self, event):
+        """ Blits the exposed parts of the window from the back buffer """
+        dc = wx.PaintDC(self)
+        if self.dc_back is None:
+            return
+        region = wx.RegionIterator(self.GetUpdateRegion())
+        while region.HaveRects():
+            rect = region.GetRect()
+            dc.Blit(rect.x, rect.y, rect.width, rect.height, self.dc_back, rect.x, rect.y)
+            self.PaintOverlay(dc, rect)
+            region.Next()
+        if self.latency_overlay:
+            self.PaintLatencyOverlay(dc)
+
+    def PaintLatencyOverlay(self, dc):
+        """ Draws the latencies at the top right of the screen (opaque, so it can be drawn again over itself) """
+        lines = [f"{kind}: p50 {stats['p50']:.1f}ms p99 {stats['p99']:.1f}ms max {stats['max']:.1f}ms ({stats['count']})"
+                 for kind, stats in self.latency.Stats().items()] or ["no input"]
+        dc.SetFont(wx.SystemSettings.GetFont(wx.SYS_DEFAULT_GUI_FONT))
+        dc.SetTextForeground(wx.Colour("white"))
+        dc.SetTextBackground(wx.Colour(60, 60, 60))
+        dc.SetBackgroundMode(wx.SOLID)
+        y = 2
+        for line in lines:
+            width, height = dc.GetTextExtent(line)
+            dc.DrawText(line, self.client_width - width - 2, y)
+            y += height
+        dc.SetBackgroundMode(wx.TRANSPARENT)
+
+    def PaintRect(self, rect, refresh=True, end_frame=True, generation=None):
+        """ Repaints the rows inside rect in the back buffer, and blits rect to the screen.
+            generation: of the damage in rect, by default the rect is new damage
+        """
+        if generation is None:
+            generation = self.latency.Damaged()
         self.dc_back.SetClippingRegion(rect)
         self.dc_back.Clear()
+        self.dc_back.DestroyClippingRegion()
         for displayed_row in self.displayed_rows:
-            if displayed_row.y + displayed_row.row.height >= rect.top:
-                self.PaintRow(self.dc_back, displayed_row.row, displayed_row.y, displayed_row.y + displayed_row.row.height)
             if displayed_row.y >= rect.bottom:
                 break
-            if self.fixed_row is not None:
+            if displayed_row.y + displayed_row.row.height > rect.top:
+                self.PaintRow(self.dc_back, displayed_row.row, displayed_row.y, displayed_row.y + displayed_row.row.height, rect,
+                              displayed_row.rowpos)
+        if self.row_cache and self.displayed_rows:
+            self.row_cache.Trim(self.displayed_rows[0].rowpos, self.displayed_rows[-1].rowpos)
+        if self.fixed_row is not None:
+            fixed_row = self.GetFixedRow()
+            if fixed_row:
+                self.dc_back.SetClippingRegion(rect)
                 self.dc_back.SetBrush( wx.TRANSPARENT_BRUSH)
                 self.dc_back.SetPen( wx.BLACK_PEN )
-                fixed_row = first(self.displayed_rows, lambda e: e.rowpos == self.fixed_row)
-                if fixed_row:
-                    self.dc_back.DrawRectangle(1, fixed_row.y+1, self.client_width-2, fixed_row.end_y - fixed_row.y - 2)
-        self.BlitToScreen(rect)
-        self.dc_back.DestroyClippingRegion()
+                self.dc_back.DrawRectangle(1, fixed_row.y+1, self.client_width-2, fixed_row.end_y - fixed_row.y - 2)
+                self.dc_back.DestroyClippingRegion()
+        self.BlitToScreen(rect, generation)
+        PAINT_STATS.pixels += rect.width * rect.height
+        if end_frame:
+            PAINT_STATS.EndFrame()
 
     def ScrollBackBufferRow(self, start_y, end_y, distance):
         self.dc_back.Blit(0, start_y+distance, self.client_width, end_y - start_y, self.dc_back, 0, start_y)
@@ -245,15 +708,18 @@ class RowScroller(wx.Window):
         self.BackBuffer = wx.Bitmap(self.client_width, self.client_height)
         self.dc_back = MemoryDC()
         self.dc_back.SelectObject(self.BackBuffer)
-        #self.ResetHeightEstimate()
-        # Estimate Height
-        max_idx = self.datamodel.GetApproximateCount()
-        if max_idx < 50:
-            rowsample = range(max_idx)
-        else:
-            rowsample = set([self.datamodel.GetApproximatePos(random.randrange(0, max_idx)) for _ in range(50)])
-        for pos in rowsample:
-            self.heights.add(pos, self.datamodel.Get(pos).height)
+        if self.row_cache:
+            self.row_cache.Clear()
+        self.heights.set_width(self.client_width)
+        # Estimate Height: sample rows only the first time, then use the histograms of the closest width
+        if not self.heights.has_samples():
+            max_idx = self.datamodel.GetApproximateCount()
+            if max_idx < 50:
+                rowsample = range(max_idx)
+            else:
+                rowsample = set([self.datamodel.GetApproximatePos(random.randrange(0, max_idx)) for _ in range(50)])
+            for pos in rowsample:
+                self.heights.add(pos, self.datamodel.Get(pos).height)
 
         if self.displayed_rows:
             rowpos, y = self.displayed_rows[0].rowpos, self.displayed_rows[0].y
@@ -263,6 +729,20 @@ class RowScroller(wx.Window):
         self.PaintRect(self.GetClientRect(), refresh=True)
         event.Skip()
 
+    def GetHeightStatistics(self):
+        """ The row height histograms as a json serializable dict, see SetHeightStatistics """
+        return self.heights.to_dict()
+
+    def SetHeightStatistics(self, data):
+        """ Restores the histograms of GetHeightStatistics (e.g. saved with the document): the scrollbar
+            is accurate without sampling rows
+        """
+        heights = RowHeigths.from_dict(data)
+        heights.set_width(self.heights.width)
+        self.heights = heights
+        if self.dc_back is not None:
+            self.RefreshScrollBar()
+
     def GetScrollPosition(self):
         return self.current_pos
 
@@ -277,12 +757,14 @@ class RowScroller(wx.Window):
     def Display(self, displayed_row, position):
         #print ("Displaying", displayed_row)
         self.displayed_rows.insert(position, displayed_row)
+        self.rows_by_pos[displayed_row.rowpos] = displayed_row
 
     def Hide(self, top=True):
         if top: 
             result = self.displayed_rows.popleft()
         else: 
             result = self.displayed_rows.pop()
+        del self.rows_by_pos[result.rowpos]
         #print ("Hiding", result)
 
     def FillRemaingRows(self):
@@ -324,9 +806,10 @@ class RowScroller(wx.Window):
         """
         y = start_px
         self.displayed_rows = deque()
+        self.rows_by_pos = {}
         if rowpos is not None:
             row = self.GetRowCached(rowpos)
-            self.displayed_rows.append(DisplayedRow(y, y+row.height, rowpos, row))
+            self.Display(DisplayedRow(y, y+row.height, rowpos, row), 0)
         self.FillRemaingRows()          
         self.RefreshScrollBar()        
 
@@ -372,7 +855,6 @@ class RowScroller(wx.Window):
 
     def ScrollIntoRectView(self, row_id, rect):
         # FIXME
-        print ("ScrollIntoRectView")
         first, last = self.layout_row_ids[0], self.layout_row_ids[-1]
         if row_id > last:
             #self.ScrollIntoViewXY2(row_id, rect.left, rect.bottom)
@@ -400,6 +882,7 @@ class RowScroller(wx.Window):
     def Scroll(self, distance, bounded_scolling=True):
         if not self.displayed_rows:
             return
+        displayed = set(self.rows_by_pos)
         self._ScrollRows(distance)
         self.FillRemaingRows()
         scrolled_pixels = distance
@@ -417,6 +900,7 @@ class RowScroller(wx.Window):
                     scrolled_pixels += dist
             self.FillRemaingRows()
         self.ClearExtraRows()
+        self.prefetcher.Viewed(self.rows_by_pos.keys() - displayed)
         self.current_pos += scrolled_pixels
         paint_rect = wx.Rect(0, 0, self.client_width, self.inner_height)
         self.PaintRect(paint_rect, refresh=True)
@@ -433,7 +917,9 @@ class RowScroller(wx.Window):
             estimated_row_height = self.heights.estimate()
             rowpos = self.datamodel.GetApproximatePos(pos // int(estimated_row_height))
             hidden_first_row = pos % int(estimated_row_height)
+            displayed = set(self.rows_by_pos)
             self.ScrollToLayout(rowpos, hidden_first_row)
+            self.prefetcher.Viewed(self.rows_by_pos.keys() - displayed)
         self.PaintRect(self.GetClientRect(), refresh=True)
         self.current_pos = pos
         self.RefreshScrollBar()
@@ -441,33 +927,37 @@ class RowScroller(wx.Window):
 
     def OnScroll(self, event):
         event_type = event.GetEventType()
+        self.latency.Input("scrollbar")
+        # The events only schedule the scroll, it is painted at the next frame
+        self.prefetcher.Cancel()
         if event_type == wx.EVT_SCROLLWIN_PAGEDOWN.typeId:
-            pos = event.GetPosition()
-            self.Scroll(self.inner_height)
+            self.scheduler.ScrollBy(self.inner_height)
         elif event_type == wx.EVT_SCROLLWIN_PAGEUP.typeId:
-            self.Scroll(-self.inner_height)
+            self.scheduler.ScrollBy(-self.inner_height)
         elif event_type == wx.EVT_SCROLLWIN_THUMBTRACK.typeId:
             pos = event.GetPosition()
-            self.ScrollTo(pos)
+            self.scheduler.ScrollTo(pos)
         elif event_type == wx.EVT_SCROLLWIN_THUMBRELEASE.typeId:
             pos = event.GetPosition()
-            self.ScrollTo(pos)
+            self.scheduler.ScrollTo(pos)
 
     def OnMouseWheel(self, event):
         rotation = event.GetWheelRotation()
         delta = event.GetWheelDelta()
-        self.Scroll(-self.line_size * (rotation / delta))
+        self.latency.Input("wheel")
+        self.prefetcher.Cancel()
+        self.scheduler.ScrollBy(-self.line_size * (rotation / delta), self.scheduler.kinetic)
 
     def __OnChar(self, event):
         key_code = event.GetKeyCode()
         if key_code == WXK_PAGEDOWN:
-            self.Scroll(self.inner_height)
+            self.scheduler.ScrollBy(self.inner_height)
         elif key_code == WXK_PAGEUP:
-            self.Scroll(-self.inner_height)
+            self.scheduler.ScrollBy(-self.inner_height)
         elif key_code == WXK_UP:
-            self.Scroll(-self.line_size)
+            self.scheduler.ScrollBy(-self.line_size)
         elif key_code == WXK_DOWN:
-            self.Scroll(self.line_size)
+            self.scheduler.ScrollBy(self.line_size)
         event.Skip()
 
 
@@ -603,7 +1093,7 @@ if __name__ == '__main__':
             self.txt1.SetLabel(str(self.ctrl.heights.estimate() * self.ctrl.datamodel.GetApproximateCount()))
             self.txt2.SetLabel(str(self.ctrl.GetScrollPosition()))
             self.txt3.SetLabel(str(self.ctrl.GetInnerHeight()))
-            self.txt4.SetLabel(str(sorted(self.ctrl.heights.row_heights.keys())))
+            self.txt4.SetLabel(str(self.ctrl.heights.row_heights.keys()))
 
         def OnLeftDown(self, event):
             x, y = event.GetPosition()
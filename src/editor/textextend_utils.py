@@ -1,41 +1,274 @@
-from editor.docmodel import TextStyle
-import wx
+from editor.docmodel import TextStyle, FontWeight, FontStyle
+from editor.fontmetrics import TrueTypeMetrics
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from itertools import accumulate
+import math
+import sys
+
+DEFAULT_STYLE = TextStyle()
+
+
+class FontPool():
+    """ wx.Font and MemoryDC (with the font selected) of each style, shared by painting and measuring.
+        Styles are keyed by their attributes. The least recently used are removed above max_size.
+    """
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.entries = OrderedDict() # style key => [font, dc or None]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def Get(self, style):
+        style = style or DEFAULT_STYLE
+        key = style.key()
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self.entries[key] = [style.GetWxFont(), None]
+            self.Trim()
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return entry
+
+    def GetFont(self, style):
+        return self.Get(style)[0]
+
+    def GetDC(self, style):
+        entry = self.Get(style)
+        if entry[1] is None:
+            # wx is only needed to measure with a DC: the other backends work without it (e.g. in worker processes)
+            import wx
+            entry[1] = dc = wx.MemoryDC()
+            dc.SetFont(entry[0])
+        return entry[1]
+
+    def SetMaxSize(self, max_size):
+        self.max_size = max_size
+        self.Trim()
+
+    def Trim(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def Clear(self):
+        self.entries.clear()
+
+    def HitRate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def Stats(self):
+        return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions, "hit_rate": self.HitRate()}
+
+
+FONT_POOL = FontPool()
 
-Measure_cache = {}
-Dc = None
-Fonts = {}
-FontDCs = {}
 
 def GetFontCached(style):
-    # TODO:: use FontList.FindOrCreateFont
-    global Fonts
-    if style not in Fonts:
-        Fonts[style] = style.GetWxFont() if style else TextStyle().GetWxFont()
-    return Fonts[style]
+    return FONT_POOL.GetFont(style)
 
 
 def GetFontDCCached(style):
-    global FontDCs
-    font = GetFontCached(style)
-    if style not in FontDCs:
-        FontDCs[style] = dc = wx.MemoryDC()
-        dc.SetFont(font)
-    return FontDCs[style]
-    
+    return FONT_POOL.GetDC(style)
+
+
+class MeasureBackend(ABC):
+    """ Measures texts in pixels for the layout. GetPartialTextExtents returns the width of text[:i+1] for each i. """
+    @abstractmethod
+    def GetPartialTextExtents(self, text, style):
+        pass
+
+    @abstractmethod
+    def GetTextExtent(self, text, style):
+        """ (width, height) """
+        pass
+
+    def GetTextExtents(self, texts, style):
+        """ (width, height) of each text, all with the same style """
+        return [self.GetTextExtent(text, style) for text in texts]
+
+
+class WxMeasureBackend(MeasureBackend):
+    """ Measures with the DCs of FONT_POOL: the same results as the painting, but needs wx (imported on the first measure) """
+    def GetPartialTextExtents(self, text, style):
+        return GetFontDCCached(style).GetPartialTextExtents(text)
+
+    def GetTextExtent(self, text, style):
+        w, h, descent, externalLeading = GetFontDCCached(style).GetFullTextExtent(text)
+        return (w, h)
+
+    def GetTextExtents(self, texts, style):
+        dc = GetFontDCCached(style)
+        result = []
+        for text in texts:
+            w, h, descent, externalLeading = dc.GetFullTextExtent(text)
+            result.append((w, h))
+        return result
+
+
+def pixel_size(style, dpi):
+    return (style or DEFAULT_STYLE).point_size * dpi / 72
+
+
+class FixedAdvanceBackend(MeasureBackend):
+    """ Every character has the same advance (a ratio of the font size, larger in bold): deterministic, for tests and benchmarks """
+    def __init__(self, advance_ratio=0.6, line_ratio=1.2, bold_ratio=1.1, dpi=96):
+        self.advance_ratio = advance_ratio
+        self.line_ratio = line_ratio
+        self.bold_ratio = bold_ratio
+        self.dpi = dpi
+
+    def GetAdvance(self, style):
+        advance = max(1, round(pixel_size(style, self.dpi) * self.advance_ratio))
+        if (style or DEFAULT_STYLE).weight == FontWeight.Bold:
+            advance = round(advance * self.bold_ratio)
+        return advance
+
+    def GetPartialTextExtents(self, text, style):
+        advance = self.GetAdvance(style)
+        return list(range(advance, advance * len(text) + 1, advance))
+
+    def GetTextExtent(self, text, style):
+        return (self.GetAdvance(style) * len(text), math.ceil(pixel_size(style, self.dpi) * self.line_ratio))
+
+
+class CharWidths(dict):
+    """ Width in pixels of each character, read from the font metrics on the first use """
+    def __init__(self, metrics, scale):
+        self.metrics = metrics
+        self.scale = scale
+
+    def __missing__(self, c):
+        width = self[c] = self.metrics.advances.get(ord(c), self.metrics.default_advance) * self.scale
+        return width
+
+
+class FontFileBackend(MeasureBackend):
+    """ Advances read from TrueType font files (see fontmetrics), without kerning.
+        The bold and italic files default to the regular one.
+    """
+    def __init__(self, regular_path, bold_path=None, italic_path=None, bold_italic_path=None, dpi=96):
+        regular = TrueTypeMetrics.from_file(regular_path)
+        bold = TrueTypeMetrics.from_file(bold_path) if bold_path else regular
+        italic = TrueTypeMetrics.from_file(italic_path) if italic_path else regular
+        bold_italic = TrueTypeMetrics.from_file(bold_italic_path) if bold_italic_path else bold
+        self.fonts = {(False, False): regular, (True, False): bold, (False, True): italic, (True, True): bold_italic}
+        self.dpi = dpi
+        self.char_widths = {} # style key => CharWidths
+
+    def GetMetrics(self, style):
+        style = style or DEFAULT_STYLE
+        return self.fonts[(style.weight == FontWeight.Bold, style.style != FontStyle.Normal)]
+
+    def GetCharWidths(self, style):
+        key = (style or DEFAULT_STYLE).key()
+        widths = self.char_widths.get(key)
+        if widths is None:
+            metrics = self.GetMetrics(style)
+            widths = self.char_widths[key] = CharWidths(metrics, pixel_size(style, self.dpi) / metrics.units_per_em)
+        return widths
+
+    def GetPartialTextExtents(self, text, style):
+        widths = self.GetCharWidths(style)
+        return [round(x) for x in accumulate(map(widths.__getitem__, text))]
+
+    def GetTextExtent(self, text, style):
+        widths = self.GetCharWidths(style)
+        metrics = self.GetMetrics(style)
+        height = math.ceil((metrics.ascender - metrics.descender) * widths.scale)
+        return (round(sum(map(widths.__getitem__, text))), height)
+
+
+MEASURE_BACKEND = WxMeasureBackend()
+
+
+def SetMeasureBackend(backend):
+    """ Measures with backend from now on, the cached measures of the previous one are cleared """
+    global MEASURE_BACKEND
+    MEASURE_BACKEND = backend
+    MEASURE_CACHE.Clear()
+
+
+class MeasureCache():
+    """ (width, height) of the measured texts keyed by (text, style key), with a LRU eviction when
+        the estimated memory used goes above max_bytes. The texts of the keys are interned.
+    """
+    ENTRY_OVERHEAD = 240 # Estimate of the dict entry, linked list node, key and value tuples
+
+    def __init__(self, max_bytes=16*1024*1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def EntrySize(self, word):
+        return sys.getsizeof(word) + self.ENTRY_OVERHEAD
+
+    def Get(self, word, style):
+        key = (word, (style or DEFAULT_STYLE).key())
+        size = self.entries.get(key)
+        if size is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return size
+        self.misses += 1
+        size = MEASURE_BACKEND.GetTextExtent(word, style)
+        self.Add(word, key[1], size)
+        return size
+
+    def Add(self, word, style_key, size):
+        self.entries[(sys.intern(word), style_key)] = size
+        self.size_bytes += self.EntrySize(word)
+        self.Trim()
+
+    def Warm(self, items):
+        """ Measures in bulk the (text, style) items that are not cached yet, one DC per style """
+        missing = OrderedDict() # style key => (style, set of words)
+        for word, style in items:
+            style_key = (style or DEFAULT_STYLE).key()
+            if (word, style_key) not in self.entries:
+                missing.setdefault(style_key, (style, set()))[1].add(word)
+        for style_key, (style, words) in missing.items():
+            words = list(words)
+            for word, size in zip(words, MEASURE_BACKEND.GetTextExtents(words, style)):
+                self.Add(word, style_key, size)
+
+    def SetMaxBytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.Trim()
+
+    def Trim(self):
+        while self.size_bytes > self.max_bytes and self.entries:
+            (word, style_key), size = self.entries.popitem(last=False)
+            self.size_bytes -= self.EntrySize(word)
+            self.evictions += 1
+
+    def Clear(self):
+        self.entries.clear()
+        self.size_bytes = 0
+
+    def HitRate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def Stats(self):
+        return {"size": len(self.entries), "bytes": self.size_bytes, "max_bytes": self.max_bytes, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions, "hit_rate": self.HitRate()}
+
+
+MEASURE_CACHE = MeasureCache()
+
 
 def GetTextExtentCached(word, style):
-    global Dc, Measure_cache
-    if (word, style) in Measure_cache:
-        return Measure_cache[(word, style)]
-    font = GetFontCached(style)
-    if Dc is None:
-        Dc = wx.MemoryDC()
-    w, h, descent, externalLeading= Dc.GetFullTextExtent(word, font)
-    #size = wx.Size(w,h)
-    Measure_cache[(word, style)] = (w, h) 
-    return w, h
+    return MEASURE_CACHE.Get(word, style)
 
 
 def GetPartialTextExtents(text, style):
-    dc = GetFontDCCached(style)
-    return dc.GetPartialTextExtents(text)
+    return MEASURE_BACKEND.GetPartialTextExtents(text, style)
@@ -1,23 +1,55 @@
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, deque
+import json
+import math
+import os
 import time
 import itertools
 
 
 class BasicProfile():
-    def __init__(self):
-        self.stats = defaultdict(list)
+    """ Durations per name: count, total, max, a log2 histogram (in microseconds), and the last
+        'max_events' calls for a trace (see editor.profiling to instrument the editor).
+    """
+    def __init__(self, max_events=100000):
         self.totals = Counter()
         self.totals_counts = Counter()
+        self.maxs = Counter()
+        self.histograms = defaultdict(Counter) # name => {log2 of the duration in us: count}
+        self.events = deque(maxlen=max_events) # (name, start, duration)
+        self.origin = time.perf_counter()
         self.current = {}
     def start(self, name):
-        self.current[name] = time.time()
+        self.current[name] = time.perf_counter()
     def end(self, name):
-        duration = time.time() - self.current[name]
-        self.stats[name].append(duration)
+        start = self.current.pop(name)
+        duration = time.perf_counter() - start
+        self.record(name, start, duration)
+    def record(self, name, start, duration):
+        """ start: time.perf_counter() at the start, duration in seconds """
         self.totals[name] += duration
         self.totals_counts[name] += 1
-
-        del self.current[name]
+        self.maxs[name] = max(self.maxs[name], duration)
+        self.histograms[name][int(duration * 1e6).bit_length()] += 1
+        self.events.append((name, start, duration))
+    def reset(self):
+        self.__init__(self.events.maxlen)
+    def summary(self):
+        """ {name: {count, total, avg, max, histogram}}, the histogram is {"<Nus": count} with N a power of 2 """
+        return {name: {"count": self.totals_counts[name],
+                       "total": total,
+                       "avg": total / self.totals_counts[name],
+                       "max": self.maxs[name],
+                       "histogram": {f"<{1 << bucket}us": count for bucket, count in sorted(self.histograms[name].items())}}
+                for name, total in self.totals.items()}
+    def to_json(self):
+        return json.dumps(self.summary(), indent=1)
+    def to_chrome_trace(self):
+        """ The recorded calls in the Chrome trace event format (chrome://tracing, Perfetto) """
+        pid = os.getpid()
+        events = [{"name": name, "cat": name.split(".")[0], "ph": "X", "pid": pid, "tid": 0,
+                   "ts": (start - self.origin) * 1e6, "dur": duration * 1e6}
+                  for name, start, duration in self.events]
+        return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
     def __repr__(self):
         avgs = {(k,v/self.totals_counts[k]) for k,v in self.totals.items()}
         return str({"cum": self.totals, "avg" : avgs})
@@ -26,6 +58,102 @@ class BasicProfile():
 PROFILE = BasicProfile()
 
 
+class PaintStats():
+    """ Draw calls, DC state changes (font, colours) and pixels repainted per painted frame """
+    def __init__(self, history=100):
+        self.draw_calls = 0
+        self.state_changes = 0
+        self.skipped = 0 # lines outside of the clipping box
+        self.pixels = 0
+        self.frames = deque(maxlen=history) # (draw_calls, state_changes, skipped, pixels) of the last frames
+
+    def EndFrame(self):
+        self.frames.append((self.draw_calls, self.state_changes, self.skipped, self.pixels))
+        self.draw_calls = self.state_changes = self.skipped = self.pixels = 0
+
+    def Stats(self):
+        count = len(self.frames) or 1
+        return {"frames": len(self.frames),
+                "draw_calls": sum(f[0] for f in self.frames) / count,
+                "state_changes": sum(f[1] for f in self.frames) / count,
+                "skipped": sum(f[2] for f in self.frames) / count,
+                "pixels": sum(f[3] for f in self.frames) / count}
+
+
+PAINT_STATS = PaintStats()
+
+
+class LatencyHistogram():
+    """ Counts of values (e.g. in microseconds) in buckets that are linear inside each power of 2, as in a
+        HdrHistogram: the memory is bounded and the percentiles are within 1/2**(sub_bucket_bits-1) of the value.
+    """
+    def __init__(self, sub_bucket_bits=5):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = Counter() # (shift, value >> shift) => count
+        self.count = 0
+        self.max = 0
+
+    def add(self, value):
+        value = int(value)
+        shift = max(value.bit_length() - self.sub_bucket_bits, 0)
+        self.counts[(shift, value >> shift)] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """ The highest value of the bucket containing the p-th percentile """
+        if not self.count:
+            return 0
+        rank = max(math.ceil(p / 100 * self.count), 1)
+        seen = 0
+        for (shift, sub_bucket), count in sorted(self.counts.items()):
+            seen += count
+            if seen >= rank:
+                return min(((sub_bucket + 1) << shift) - 1, self.max)
+        return self.max
+
+
+class LatencyTracker():
+    """ Time from each input event (Input) to the blit to the screen showing its effect (Blitted).
+        The damage (the parts to repaint) is numbered by Damaged: a blit completes the inputs received
+        before its damage was created, so a blit of older damage or of no damage at all (e.g. a caret blink,
+        an expose event) doesn't complete an input.
+        Inputs without any blit in 'timeout' seconds are dropped (e.g. a key that changes nothing).
+    """
+    def __init__(self, timeout=1.0):
+        self.timeout = timeout
+        self.pending = deque() # (kind, time.perf_counter(), damage generation when received)
+        self.histograms = defaultdict(LatencyHistogram) # kind => latencies in us
+        self.unmatched = 0
+        self.generation = 0
+
+    def Input(self, kind):
+        self.pending.append((kind, time.perf_counter(), self.generation))
+
+    def Damaged(self):
+        """ New damage (after all the inputs received so far): returns its generation, for Blitted """
+        self.generation += 1
+        return self.generation
+
+    def Blitted(self, generation):
+        """ The damage of 'generation' (and the older damage) is on the screen """
+        now = time.perf_counter()
+        while self.pending and (self.pending[0][2] < generation or now - self.pending[0][1] > self.timeout):
+            kind, start, input_generation = self.pending.popleft()
+            if now - start > self.timeout:
+                self.unmatched += 1
+            else:
+                self.histograms[kind].add((now - start) * 1e6)
+
+    def Stats(self):
+        """ {kind: {count, p50, p99, max}}, in milliseconds """
+        return {kind: {"count": histogram.count,
+                       "p50": histogram.percentile(50) / 1000,
+                       "p99": histogram.percentile(99) / 1000,
+                       "max": histogram.max / 1000}
+                for kind, histogram in sorted(self.histograms.items())}
+
+
 def flatten_list(lst_of_lst):
     return list(itertools.chain(*lst_of_lst))
 
@@ -1,4 +1,18 @@
-from editor.textextend_utils import GetPartialTextExtents, GetTextExtentCached
+from editor.textextend_utils import GetPartialTextExtents, GetTextExtentCached, MEASURE_CACHE
+from editor.docmodel import RichText
+from editor.linebreak import line_breaks, line_breaks_cached, mandatory_breaks, BREAK_CLASS_CHARS, BK
+from bisect import bisect_left, bisect_right
+from collections import deque
+import re
+
+# Characters after which next_wrap_position wraps (the complement of str.isalnum)
+NON_ALNUM_RE = re.compile(r"[\W_]")
+# Not counted in the width of a word that must be split (see word_end)
+HANGING_CHARS = " " + BREAK_CLASS_CHARS[BK]
+# next_wrap_position forces a wrap after this many alphanumeric characters
+MAX_WORD_LENGTH = 32
+# Characters measured for the first line by wrap_line_positions, the next lines start from the length of the previous one
+LINE_WINDOW = 64
 
 
 def parse_text(text):
@@ -58,17 +72,220 @@ def wrap_next(text, text_extend_list, start_pos, max_width):
     return (prev_pos)
 
 
-def wrap_text(text, style, max_width, first_width=None):
-    text_extends = [0] + GetPartialTextExtents(text, style)
-    pos, prev_pos = 0, 0
+def break_positions(text):
+    """ All the positions returned by chaining next_wrap_position from 0, computed in one pass.
+        The non alphanumeric characters are found by the regex, only the forced breaks
+        of long words are added in python.
+    """
+    ends = [m.end() for m in NON_ALNUM_RE.finditer(text)] + [len(text)]
+    result = []
+    pos, i = 0, 0
+    while pos < len(text):
+        i = bisect_right(ends, pos, i)
+        pos = min(ends[i], pos + MAX_WORD_LENGTH)
+        result.append(pos)
+    return result
+
+
+def word_end(text, pos, end):
+    """ end without the spaces and newline ending text[pos:end]: they hang over the margin (UAX #14) """
+    while end > pos + 1 and text[end-1] in HANGING_CHARS:
+        end -= 1
+    return end
+
+
+def wrap_positions(text_extends, breaks, max_width, first_width=None, split_words=False, start=0, mandatory=(), text=None,
+                   strict=False):
+    """ Yields the end of each line, choosing among the sorted 'breaks' positions.
+        text_extends[i] is the width of text[:i] (so it is sorted), the lines ending
+        at or before the width limit are found using a bisect (same as PaintedParagraph.HasSpace),
+        or strictly before it if 'strict' is set (same as wrap_next).
+        When no break fits on a line, the first break is taken (same as wrap_next), unless
+        split_words is set and the word doesn't even fit on a line of its own.
+        start: the position where the first line starts
+        mandatory: sorted positions where a line must end (see linebreak.mandatory_breaks)
+        text: when given, the spaces after a split word stay at the end of its line
+    """
+    pos = start
     wrap_width = first_width or max_width
+    m = bisect_right(mandatory, pos)
+    fit = bisect_left if strict else bisect_right
+    while pos < len(text_extends) - 1:
+        # First position that doesn't fit
+        limit = fit(text_extends, text_extends[pos] + wrap_width)
+        i = bisect_left(breaks, limit) - 1
+        if i < 0 or breaks[i] <= pos:
+            i = bisect_right(breaks, pos)
+            end = word_end(text, pos, breaks[i]) if text is not None else breaks[i]
+            if split_words and text_extends[end] - text_extends[pos] > max_width:
+                # Split the word where a full line ends
+                full_line_limit = fit(text_extends, text_extends[pos] + max_width)
+                wrap_width = max_width
+                pos = max(full_line_limit - 1, pos + 1)
+                yield pos
+                continue
+        next_pos = breaks[i]
+        if m < len(mandatory) and mandatory[m] < next_pos:
+            next_pos = mandatory[m]
+        while m < len(mandatory) and mandatory[m] <= next_pos:
+            m += 1
+        wrap_width = max_width
+        pos = next_pos
+        yield pos
+
+
+def split_long_words(text_extends, breaks, max_width, text=None):
+    """ Adds break positions inside the words that don't fit on a line of their own """
+    result = []
+    pos = 0
+    for next_pos in breaks:
+        end = word_end(text, pos, next_pos) if text is not None else next_pos
+        while text_extends[end] - text_extends[pos] > max_width:
+            split_pos = max(bisect_right(text_extends, text_extends[pos] + max_width) - 1, pos + 1)
+            if split_pos >= end:
+                break
+            result.append(split_pos)
+            pos = split_pos
+        result.append(next_pos)
+        pos = next_pos
+    return result
+
+
+def optimal_wrap_positions(text_extends, breaks, max_width, first_width=None, window=64, start=0):
+    """ Yields the end of each line, choosing the breaks that minimize the sum over the lines of the
+        squared empty space at the end of the line (Knuth-Plass, without stretching or hyphenation).
+        The last line has no cost. Only the 'window' last breaks that still fit on a line are kept
+        as possible line starts, so this is linear in the number of breaks.
+        Words that don't fit are kept on a line of their own.
+        start: the position where the first line starts, the breaks must be after it
+    """
+    if not breaks:
+        return
+    nodes = [start] + breaks
+    costs = [0] + [None] * len(breaks)
+    previous = [None] * len(nodes)
+    active = deque([0], maxlen=window)
+    last = len(nodes) - 1
+    for j in range(1, len(nodes)):
+        end_width = text_extends[nodes[j]]
+        # Extents only grow: a line start that doesn't fit any more will never fit again
+        while active and end_width - text_extends[nodes[active[0]]] > (active[0] == 0 and first_width or max_width):
+            active.popleft()
+        best = None
+        for i in active:
+            slack = (i == 0 and first_width or max_width) - (end_width - text_extends[nodes[i]])
+            cost = costs[i] + (0 if j == last else slack * slack)
+            if best is None or cost < best:
+                best, previous[j] = cost, i
+        if best is None:
+            # Nothing fits: the word goes on its own line after the previous break
+            slack = max_width - (end_width - text_extends[nodes[j-1]])
+            best, previous[j] = costs[j-1] + slack * slack, j-1
+        costs[j] = best
+        active.append(j)
+    result = []
+    j = last
+    while j:
+        result.append(nodes[j])
+        j = previous[j]
+    yield from reversed(result)
+
+
+def wrap_line_positions(text, style, max_width, first_width=None, start=0):
+    """ The positions of wrap_positions with the breaks of linebreak.line_breaks and split_words, but each line
+        is measured and searched for breaks from its own start, in a window of text a bit longer than the line:
+        the cost is proportional to the lines wrapped, not to the length of the text (e.g. Rewrap in a long text).
+    """
+    pos = start
+    wrap_width = first_width or max_width
+    window = LINE_WINDOW
     while pos < len(text):
-        next_pos = wrap_next(text, text_extends, pos, wrap_width)
+        end = min(pos + window, len(text))
+        while True:
+            # The spaces at the end of a line hang in the margin: the window never ends inside them
+            while end < len(text) and text[end] in HANGING_CHARS:
+                end += 1
+            extents = [0] + GetPartialTextExtents(text[pos:end], style)
+            if end == len(text) or extents[-1] > max(wrap_width, max_width):
+                break
+            end = min(pos + 2 * (end - pos), len(text))
+        # One more character: the break at 'end' depends on the character after it
+        part = text[pos:end+1]
+        breaks = line_breaks(part)
+        mandatory = mandatory_breaks(part)
+        hanging = part
+        if end < len(text):
+            breaks.pop() # the end of part is not the end of the text
+            mandatory = mandatory[:bisect_right(mandatory, end - pos)]
+            if not breaks:
+                # A word wider than a line: it is split before the end of the window
+                breaks, hanging = [end - pos], None
+        line_end = next(wrap_positions(extents, breaks, max_width, wrap_width, True, 0, mandatory, hanging))
+        window = max(line_end + line_end // 4, 16)
         wrap_width = max_width
+        pos += line_end
+        yield pos
+
+
+def optimal_paragraphs_positions(text_extends, breaks, max_width, first_width, mandatory):
+    """ optimal_wrap_positions of each part of the text ending with a mandatory break """
+    pos = 0
+    for end in mandatory + [len(text_extends) - 1]:
+        if end > pos:
+            part = breaks[bisect_right(breaks, pos):bisect_right(breaks, end)]
+            yield from optimal_wrap_positions(text_extends, part, max_width, first_width if pos == 0 else None, start=pos)
+            pos = end
+
+
+def wrap_text(text, style, max_width, first_width=None, breaks=None, optimal=False, start=0):
+    """ Yields the lines of text.
+        breaks: the line break opportunities (e.g. from linebreak.line_breaks_cached), in which case
+        words longer than a line are split, the lines always end after the newlines (mandatory breaks)
+        and a line can be as wide as max_width. Without optimal, wrap_line_positions finds the same breaks
+        again for each line, and only measures the lines wrapped.
+        By default, the lines are the ones of wrap_next: the breaks of next_wrap_position are used,
+        newlines are ordinary breaks and a line must be narrower than max_width.
+        optimal: use optimal_wrap_positions instead of filling the lines one by one.
+        start: wrap only text[start:], start being the beginning of a line (not with optimal).
+        The lines are the same as when wrapping from 0.
+    """
+    if breaks is not None and not optimal:
+        positions = wrap_line_positions(text, style, max_width, first_width, start)
+    elif optimal:
+        text_extends = [0] + GetPartialTextExtents(text, style)
+        if breaks is not None:
+            positions = optimal_paragraphs_positions(text_extends, split_long_words(text_extends, breaks, max_width, text),
+                                                     max_width, first_width, mandatory_breaks(text))
+        else:
+            positions = optimal_paragraphs_positions(text_extends, break_positions(text), max_width, first_width, [])
+    else:
+        text_extends = [0] + GetPartialTextExtents(text, style)
+        positions = wrap_positions(text_extends, break_positions(text), max_width, first_width, start=start, strict=True)
+    pos = start
+    for next_pos in positions:
         yield(text[pos:next_pos])
         pos = next_pos
 
 
+def warm_measure_cache(document, max_width):
+    """ Measures in bulk the lines of all the texts of the document, wrapped as in PaintedParagraph.
+        (the first line of each text is wrapped as if it started a line)
+    """
+    items = []
+    for paragraph in document.elements:
+        optimal = bool(paragraph.style and paragraph.style.optimal_wrap)
+        for rich_text in paragraph.rich_texts:
+            if type(rich_text) is not RichText:
+                continue
+            if rich_text.text == "":
+                items.append(("a", rich_text.style))
+            else:
+                breaks = line_breaks_cached(rich_text)
+                items.extend((text, rich_text.style) for text in wrap_text(rich_text.text, rich_text.style, max_width,
+                                                                           breaks=breaks, optimal=optimal))
+    MEASURE_CACHE.Warm(items)
+
+
 if __name__ == '__main__':
     import wx
     app = wx.App()
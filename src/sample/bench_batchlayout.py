@@ -0,0 +1,18 @@
+import time
+from editor.docmodel import Paragraph, RichText, RichTextDocument, TextStyle, FontWeight
+from editor.batchlayout import BatchLayout
+from editor.util import clone_multiply_list
+
+PAGE_WIDTH = 700
+PAGE_HEIGHT = 1000
+
+
+if __name__ == '__main__':
+    document = RichTextDocument(clone_multiply_list([Paragraph(RichText("hello hueuizeeuih ezhu zeiuhezu+ no word wrap, font sizes, bold, unde"*10)),
+                                                     Paragraph(RichText("Hello", style=TextStyle(point_size=10)), RichText("World", style=TextStyle(point_size=40))),
+                                                     Paragraph(RichText("bold part of the paragraph "*20, style=TextStyle(point_size=12, weight=FontWeight.Bold)))], 3000))
+    for workers in (1, 2, 4, 8):
+        start = time.perf_counter()
+        line_heights, page_starts = BatchLayout(workers=workers).Paginate(document, PAGE_WIDTH, PAGE_HEIGHT)
+        duration = time.perf_counter() - start
+        print (f"{workers} workers: {len(page_starts)} pages in {duration:.2f}s ({len(page_starts)/duration:.0f} pages/s)")
@@ -0,0 +1,39 @@
+import time
+import wx
+from editor.docmodel import Paragraph, RichText, TextStyle, FontWeight
+from editor.richtext import PaintedParagraph
+
+
+def linear_hit_test(painted_paragraph, x, y):
+    """ The hit test as it was before the line index: scan every element """
+    for elm in painted_paragraph.elements:
+        if elm.Contains(x, y):
+            return elm
+    for elm in reversed(painted_paragraph.elements):
+        if elm.ContainsY(y):
+            return elm
+
+
+def drag_path(width, height, count):
+    """ Mouse positions of a diagonal drag selection from the top left to the bottom right """
+    for i in range(count):
+        yield (width * i // count, height * i // count)
+
+
+def bench(name, fct, positions):
+    start = time.perf_counter()
+    for x, y in positions:
+        fct(x, y)
+    duration = time.perf_counter() - start
+    print (f"{name:>10}: {len(positions)} motion events in {duration*1000:.1f}ms ({duration/len(positions)*1e6:.1f}us/event)")
+
+
+if __name__ == '__main__':
+    app = wx.App()
+    paragraph = Paragraph(*[RichText("hello hueuizeeuih ezhu zeiuhezu+ no word wrap, font sizes, bold, unde"*20),
+                            RichText("bold part of the paragraph "*50, style=TextStyle(point_size=12, weight=FontWeight.Bold))] * 20)
+    painted = PaintedParagraph.from_paragraph(0, paragraph, 800)
+    positions = list(drag_path(800, painted.height, 10000))
+    print (f"{len(painted.elements)} elements on {len(painted.lines)} lines")
+    bench("linear", lambda x, y: linear_hit_test(painted, x, y).HitTest(x, y), positions)
+    bench("bisect", painted.HitTest, positions)
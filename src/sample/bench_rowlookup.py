@@ -0,0 +1,43 @@
+import time
+import wx
+from editor.scrolled import RowScroller, ColorRowModel, ColorRow
+from editor.util import first
+
+VIEWPORT_HEIGHT = 2160 # 4K
+ROW_HEIGHT = 16 # one line rows
+REPEAT = 50
+
+
+class OneLineRowModel(ColorRowModel):
+    def __init__(self):
+        super().__init__()
+        self.count = self.real_count
+        self.rows = [ColorRow(idx, height=ROW_HEIGHT) for idx in range(self.real_count)]
+
+
+def bench(name, fct):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        fct()
+    duration = time.perf_counter() - start
+    print (f"{name:>28}: {duration/REPEAT*1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    app = wx.App()
+    frame = wx.Frame(None, size=(800, VIEWPORT_HEIGHT))
+    ctrl = RowScroller(OneLineRowModel(), frame)
+    sizer = wx.BoxSizer(wx.VERTICAL)
+    sizer.Add(ctrl, 1, wx.EXPAND)
+    frame.SetSizer(sizer)
+    frame.Show()
+    frame.Layout()
+    wx.Yield()
+    rowpositions = [d.rowpos for d in ctrl.displayed_rows]
+    print (f"{len(rowpositions)} rows displayed in {ctrl.client_height}px")
+    ctrl.SetFixedRow(rowpositions[len(rowpositions) // 2])
+    bench("linear lookup of every row", lambda: [first(ctrl.displayed_rows, lambda e: e.rowpos == p) for p in rowpositions])
+    bench("indexed lookup of every row", lambda: [ctrl.GetDisplayedRow(p) for p in rowpositions])
+    bench("full repaint", lambda: ctrl.PaintRect(ctrl.GetClientRect()))
+    bench("every row modified", lambda: [ctrl.OnModified(p) for p in rowpositions])
+    bench("scroll one line", lambda: ctrl.Scroll(ROW_HEIGHT))
@@ -0,0 +1,39 @@
+import time
+import wx
+from editor.scrolled import RowScroller, ColorRowModel
+from editor.richtext import CustomRichTextControl
+from editor.docmodel import Paragraph, RichText, RichTextDocument, TextStyle, FontWeight
+from editor.util import clone_multiply_list
+
+TICKS = 300
+
+
+def bench(name, ctrl, cached):
+    ctrl.EnableRowCache(cached)
+    ctrl.ScrollToLayout(ctrl.datamodel.GetFirstPos(), 0)
+    ctrl.PaintRect(ctrl.GetClientRect())
+    start = time.perf_counter()
+    for i in range(TICKS):
+        # Wheel ticks down then up, so that the cached rows are displayed again
+        ctrl.Scroll(ctrl.line_size * 3 if i < TICKS // 2 else -ctrl.line_size * 3)
+    duration = time.perf_counter() - start
+    stats = ctrl.row_cache.Stats() if ctrl.row_cache else {}
+    print (f"{name:>10} {'cached' if cached else 'uncached':>8}: {TICKS/duration:.0f} scrolls/s {stats}")
+
+
+if __name__ == '__main__':
+    app = wx.App()
+    frame = wx.Frame(None, size=(800, 1000))
+    document = RichTextDocument(clone_multiply_list([Paragraph(RichText("hello hueuizeeuih ezhu zeiuhezu+ no word wrap, font sizes, bold, unde"*3)),
+                                                     Paragraph(RichText("bold part of the paragraph "*5, style=TextStyle(point_size=12, weight=FontWeight.Bold)))], 500))
+    controls = [("colorrows", RowScroller(ColorRowModel(), frame)), ("richtext", CustomRichTextControl(document, frame))]
+    sizer = wx.BoxSizer(wx.VERTICAL)
+    for name, ctrl in controls:
+        sizer.Add(ctrl, 1, wx.EXPAND)
+    frame.SetSizer(sizer)
+    frame.Show()
+    frame.Layout()
+    wx.Yield()
+    for name, ctrl in controls:
+        for cached in (False, True):
+            bench(name, ctrl, cached)
@@ -0,0 +1,17 @@
+import os
+import sys
+import pytest
+
+# The modules are imported as editor.xxx, from the src directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from editor import textextend_utils
+
+
+@pytest.fixture
+def fixed_advance():
+    """ Measures with FixedAdvanceBackend (7 pixels per character with the default style) """
+    previous = textextend_utils.MEASURE_BACKEND
+    textextend_utils.SetMeasureBackend(textextend_utils.FixedAdvanceBackend())
+    yield textextend_utils.MEASURE_BACKEND
+    textextend_utils.SetMeasureBackend(previous)
@@ -0,0 +1,131 @@
+import struct
+import pytest
+
+wx = pytest.importorskip("wx")
+
+from editor import imagecache, richtext
+from editor.docmodel import Image, Paragraph, RichTextDocument
+from editor.richtext import PaintedImage, PaintedParagraph, PaintedParagraphDataModel
+
+WIDTH, HEIGHT = 400, 300
+PNG_HEADER = b"\x89PNG\r\n\x1a\n" + b"\0\0\0\x0d" + b"IHDR" + struct.pack(">II", WIDTH, HEIGHT)
+
+
+class FakeImage():
+    """ Only what the cache uses of a wx.Image """
+    def __init__(self, width, height, ok=True):
+        self.width, self.height, self.ok = width, height, ok
+
+    def IsOk(self):
+        return self.ok
+
+    def GetWidth(self):
+        return self.width
+
+    def GetHeight(self):
+        return self.height
+
+    def HasAlpha(self):
+        return False
+
+    def Scale(self, width, height, quality):
+        return FakeImage(width, height)
+
+
+class FakeTiledBitmap():
+    def __init__(self, image):
+        self.width, self.height = image.GetWidth(), image.GetHeight()
+
+    def GetWidth(self):
+        return self.width
+
+    def GetHeight(self):
+        return self.height
+
+    def Bytes(self):
+        return self.width * self.height * 4
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = imagecache.ImageCache()
+    cache.requests = []
+    monkeypatch.setattr(cache, "DecodeAsync", lambda key, data, width: cache.requests.append((key, width)))
+    monkeypatch.setattr(imagecache, "TiledBitmap", FakeTiledBitmap)
+    monkeypatch.setattr(richtext, "IMAGE_CACHE", cache)
+    monkeypatch.setattr(wx, "GetApp", lambda: True)
+    return cache
+
+
+def image_model(image, width=WIDTH):
+    model = PaintedParagraphDataModel(RichTextDocument([Paragraph(image)]))
+    model.SetMaxWidth(width + 2 * PaintedImage.MARGIN)
+    return model
+
+
+def test_upscaled_image_is_laid_out_again_when_decoded(cache):
+    image = Image(PNG_HEADER)
+    key = image.key()
+    # Only a small level is decoded (e.g. before a zoom in)
+    cache.AddLevel(key, 2, FakeImage(WIDTH >> 2, HEIGHT >> 2))
+    model = image_model(image)
+    layout = model.Get(0)
+    assert layout.elements[0].layout.width == WIDTH + 2 * PaintedImage.MARGIN
+    assert cache.IsUpscaled(key, WIDTH)
+    assert layout.pending_images == [key]
+    assert cache.requests == [(key, WIDTH)]
+
+    modified = []
+    model.MODIFIED.subscribe(lambda pos, rects: modified.append(pos))
+    cache.OnDecoded((key, 0), 0, FakeImage(WIDTH, HEIGHT))
+    assert modified == [0]
+    layout = model.Get(0)
+    assert not cache.IsUpscaled(key, WIDTH)
+    assert layout.pending_images == []
+
+
+def test_failed_image_is_not_pending(cache):
+    image = Image(PNG_HEADER)
+    key = image.key()
+    model = image_model(image)
+    assert model.Get(0).pending_images == [key]
+    assert model.waiting_images.items() == [(0, {key})]
+    cache.OnDecoded((key, 0), None, FakeImage(0, 0, ok=False))
+    assert cache.IsFailed(key)
+    assert model.waiting_images.items() == []
+    layout = model.Get(0)
+    assert layout.pending_images == []
+    assert layout.elements[0].layout.bitmap is None
+    assert model.waiting_images.items() == []
+
+
+def test_waiting_image_is_shifted(cache):
+    image = Image(PNG_HEADER)
+    key = image.key()
+    model = image_model(image)
+    layout = model.Get(0)
+    model.document.InsertParagraph(0, Paragraph())
+    model.Inserted(0)
+    assert model.GetRowCached(1) is layout
+    assert model.waiting_images.items() == [(1, {key})]
+    modified = []
+    model.MODIFIED.subscribe(lambda pos, rects: modified.append(pos))
+    cache.OnDecoded((key, 0), 0, FakeImage(WIDTH, HEIGHT))
+    assert modified == [1]
+    assert model.GetRowCached(1) is None
+
+
+def test_decode_once_per_level(monkeypatch):
+    cache = imagecache.ImageCache()
+    queued = []
+    monkeypatch.setattr(cache, "thread", object())
+    monkeypatch.setattr(cache.queue, "put", queued.append)
+    cache.sizes["k"] = (WIDTH, HEIGHT)
+    cache.DecodeAsync("k", b"", WIDTH // 4)
+    cache.DecodeAsync("k", b"", WIDTH // 4)
+    # A larger width while the smaller one is decoded
+    cache.DecodeAsync("k", b"", WIDTH)
+    assert [request for request, data, width in queued] == [("k", 2), ("k", 0)]
+    assert cache.pending == {("k", 2), ("k", 0)}
+    cache.OnDecoded(("k", 2), 2, FakeImage(WIDTH >> 2, HEIGHT >> 2))
+    assert cache.pending == {("k", 0)}
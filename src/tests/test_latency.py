@@ -0,0 +1,55 @@
+import math
+import random
+from editor.util import LatencyHistogram, LatencyTracker
+
+
+def exact_percentile(values, p):
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)), 1) - 1]
+
+
+def test_empty_histogram():
+    assert LatencyHistogram().percentile(99) == 0
+
+
+def test_small_values_are_exact():
+    histogram = LatencyHistogram()
+    for value in range(1, 33):
+        histogram.add(value)
+    assert histogram.percentile(50) == 16
+    assert histogram.percentile(100) == 32
+    assert histogram.max == 32
+
+
+def test_percentiles_within_the_bucket_precision():
+    rng = random.Random(0)
+    values = [int(rng.lognormvariate(8, 1.5)) for _ in range(20000)]
+    histogram = LatencyHistogram(sub_bucket_bits=5)
+    for value in values:
+        histogram.add(value)
+    assert histogram.count == len(values)
+    for p in (1, 50, 90, 99, 99.9, 100):
+        exact = exact_percentile(values, p)
+        assert exact <= histogram.percentile(p) <= exact * (1 + 1 / 16), p
+    assert histogram.percentile(100) == max(values)
+
+
+def test_blit_completes_only_older_inputs():
+    tracker = LatencyTracker()
+    before = tracker.Damaged()
+    tracker.Input("key")
+    # e.g. a caret blink or the blit of damage older than the key
+    tracker.Blitted(before)
+    assert not tracker.histograms
+    tracker.Input("wheel")
+    tracker.Blitted(tracker.Damaged())
+    assert {kind: h.count for kind, h in tracker.histograms.items()} == {"key": 1, "wheel": 1}
+    assert not tracker.pending
+
+
+def test_inputs_without_blit_time_out():
+    tracker = LatencyTracker(timeout=-1)
+    tracker.Input("key")
+    tracker.Blitted(0)
+    assert tracker.unmatched == 1
+    assert not tracker.histograms
@@ -0,0 +1,59 @@
+import random
+import pytest
+
+wx = pytest.importorskip("wx")
+
+from editor.docmodel import Paragraph, ParagraphStyle, RichText, Alignment
+from editor.richtext import PaintedParagraph
+
+WORDS = ["elit", "eiusmod", "sit", "do", "a", "lorem", "ipsumdolorsitametconsectetur", "\n", "x-y", "  "]
+
+
+def lines(layout):
+    return [[(elm.rich_text_idx, elm.split_offset, elm.layout.text, elm.x, elm.y) for elm in line]
+            for line in layout.lines]
+
+
+def check_rewrap(paragraph, max_width, edit):
+    layout = PaintedParagraph.from_paragraph(0, paragraph, max_width)
+    edit(paragraph)
+    rects = layout.Rewrap(paragraph)
+    expected = PaintedParagraph.from_paragraph(0, paragraph, max_width)
+    if rects is not None:
+        assert lines(layout) == lines(expected)
+        assert layout.height == expected.height
+    return rects
+
+
+@pytest.mark.parametrize("max_width", [56, 80, 84])
+def test_rewrap_each_offset(fixed_advance, max_width):
+    text = "elit eiusmod sit do"
+    for offset in range(len(text) + 1):
+        for edit in (lambda p: p.rich_texts[0].insert(offset, " "), lambda p: p.rich_texts[0].insert(offset, "e"),
+                     lambda p: p.rich_texts[0].remove(offset, 1) if offset < len(text) else None):
+            check_rewrap(Paragraph(RichText(text)), max_width, edit)
+
+
+def test_rewrap_fuzz(fixed_advance):
+    rng = random.Random(0)
+    for _ in range(2000):
+        texts = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12))) for _ in range(rng.randint(1, 3))]
+        idx = rng.randrange(len(texts))
+        offset = rng.randint(0, len(texts[idx]))
+        if offset < len(texts[idx]) and rng.random() < 0.5:
+            count = rng.randint(1, min(4, len(texts[idx]) - offset))
+            edit = lambda p: p.rich_texts[idx].remove(offset, count)
+        else:
+            word = rng.choice(WORDS + [" ", "e"])
+            edit = lambda p: p.rich_texts[idx].insert(offset, word)
+        check_rewrap(Paragraph(*[RichText(text) for text in texts]), rng.randint(20, 200), edit)
+
+
+def test_justify_skips_the_newlines(fixed_advance):
+    paragraph = Paragraph(RichText("aa bb\ncc dd ee ff"), style=ParagraphStyle(Alignment.Justify))
+    layout = PaintedParagraph.from_paragraph(0, paragraph, 70)
+    assert [[elm.layout.text for elm in line] for line in layout.lines] == [["aa bb\n"], ["cc dd ee "], ["ff"]]
+    # The line ending with a newline stays on the left, the trailing spaces and newline are not widened
+    assert layout.lines[0][0].layout.text_extends == [7 * i for i in range(7)]
+    assert layout.lines[1][0].layout.text_extends[-1] - layout.lines[1][0].layout.TrailingSpaceWidth() == 70
+    assert layout.lines[0][0].layout.TrailingSpaceWidth() == 7
@@ -0,0 +1,66 @@
+import random
+import pytest
+from editor.rowstore import RowStore
+
+
+def test_empty():
+    store = RowStore()
+    assert len(store) == 0
+    assert store.total() == 0
+    assert store.get(3) is None
+    with pytest.raises(KeyError):
+        store.pop(3)
+    assert store.pop(3, None) is None
+
+
+def test_insert_and_remove_rows():
+    store = RowStore([(0, 10), (5, 20), (9, 30)])
+    store.insert_rows(5, 2, [None, 7])
+    assert store.items() == [(0, 10), (6, 7), (7, 20), (11, 30)]
+    assert store.remove_rows(6, 3) == [(6, 7), (7, 20)]
+    assert store.items() == [(0, 10), (8, 30)]
+    assert store.total(1, 9) == 30
+
+
+def test_same_as_a_dict():
+    """ Random operations on a RowStore and on a dict of the same rows, rebuilt at each shift """
+    rng = random.Random(0)
+    store, model = RowStore(), {}
+    for _ in range(5000):
+        operation = rng.random()
+        pos = rng.randrange(200)
+        if operation < 0.4:
+            value = rng.randrange(1, 100)
+            store.set(pos, value)
+            model[pos] = value
+        elif operation < 0.5:
+            assert store.pop(pos, None) == model.pop(pos, None)
+        elif operation < 0.65:
+            values = [rng.choice([None, rng.randrange(1, 100)]) for _ in range(rng.randint(1, 5))]
+            store.insert_rows(pos, len(values), values)
+            model = {key + len(values) if key >= pos else key: value for key, value in model.items()}
+            model.update((pos + i, value) for i, value in enumerate(values) if value is not None)
+        elif operation < 0.8:
+            count = rng.randint(1, 5)
+            removed = sorted((key, value) for key, value in model.items() if pos <= key < pos + count)
+            assert store.remove_rows(pos, count) == removed
+            model = {key - count if key >= pos + count else key: value for key, value in model.items()
+                     if not pos <= key < pos + count}
+        else:
+            start, end = sorted(rng.randrange(250) for _ in range(2))
+            assert store.total(start, end) == sum(value for key, value in model.items() if start <= key < end)
+        assert len(store) == len(model)
+        assert (pos in store) == (pos in model)
+        assert store.get(pos) == model.get(pos)
+    assert store.items() == sorted(model.items())
+    assert store.keys() == sorted(model)
+    assert store.total() == sum(model.values())
+
+
+def test_not_summed():
+    store = RowStore([(2, "b"), (0, "a")], summed=False)
+    store.insert_rows(1, 2, ["x", None])
+    assert store.items() == [(0, "a"), (1, "x"), (4, "b")]
+    assert store.items(1, 4) == [(1, "x")]
+    assert store.remove_rows(0, 2) == [(0, "a"), (1, "x")]
+    assert store.items() == [(2, "b")]
@@ -0,0 +1,47 @@
+import random
+from editor.docmodel import CaretPosition, Selection, selection_changes
+
+PARAGRAPHS = 30
+
+
+def random_selection(rng):
+    if rng.random() < 0.1:
+        return None
+    carets = [CaretPosition(rng.randrange(PARAGRAPHS), rng.randrange(2), rng.randrange(5)) for _ in range(2)]
+    return Selection(*carets)
+
+
+def paragraph_range(selection, pos):
+    return selection and selection.ParagraphRange(pos)
+
+
+def test_no_selection():
+    assert selection_changes(None, None) == []
+
+
+def test_disjoint_selections():
+    old = Selection(CaretPosition(2, 0, 1), CaretPosition(4, 0, 0))
+    new = Selection(CaretPosition(7, 0, 0), CaretPosition(8, 0, 3))
+    assert selection_changes(old, new) == [range(2, 5), range(7, 9)]
+
+
+def test_drag_changes_only_the_end():
+    old = Selection(CaretPosition(2, 0, 1), CaretPosition(10, 0, 0))
+    new = Selection(CaretPosition(2, 0, 1), CaretPosition(11, 0, 4))
+    assert selection_changes(old, new) == [range(2, 3), range(10, 12)]
+
+
+def test_random_selections():
+    rng = random.Random(0)
+    for _ in range(5000):
+        old, new = random_selection(rng), random_selection(rng)
+        changes = set()
+        for changed in selection_changes(old, new):
+            changes.update(changed)
+        for pos in range(PARAGRAPHS):
+            old_range, new_range = paragraph_range(old, pos), paragraph_range(new, pos)
+            if old_range != new_range:
+                assert pos in changes, (old, new, pos)
+            elif old_range == (None, None):
+                # Selected entirely by both
+                assert pos not in changes, (old, new, pos)
@@ -0,0 +1,110 @@
+import random
+import pytest
+from editor.linebreak import line_breaks, mandatory_breaks
+from editor.textextend_utils import GetPartialTextExtents
+from editor.wrapping import wrap_text, wrap_next, wrap_positions, wrap_line_positions
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "a", "consecteturadipiscingelit", "x-y", "(b)", "c.", "\n", "  "]
+
+
+def random_text(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 20)))
+
+
+def test_line_breaks():
+    assert line_breaks("") == []
+    assert line_breaks("ab cd") == [3, 5]
+    assert line_breaks("ab\ncd") == [3, 5]
+    assert line_breaks("ab\r\ncd") == [4, 6]
+    assert line_breaks("x-y (b) c.") == [2, 4, 8, 10]
+
+
+def test_mandatory_breaks():
+    assert mandatory_breaks("ab cd") == []
+    assert mandatory_breaks("ab\ncd\n") == [3, 6]
+    assert mandatory_breaks("ab\r\ncd ") == [4, 7]
+
+
+@pytest.mark.parametrize("optimal", [False, True])
+def test_newline_ends_the_line(fixed_advance, optimal):
+    text = "ab\ncd ef\n\ngh"
+    assert list(wrap_text(text, None, 700, breaks=line_breaks(text), optimal=optimal)) == ["ab\n", "cd ef\n", "\n", "gh"]
+
+
+def test_trailing_spaces_stay_with_the_word(fixed_advance):
+    # 'eiusmod' fits on a line of 56 pixels, not 'eiusmod ': the space must not start the next line
+    text = "elit eiusmod sit do"
+    lines = list(wrap_text(text, None, 56, breaks=line_breaks(text)))
+    assert lines == ["elit ", "eiusmod ", "sit do"]
+
+
+def test_line_filling_the_width_fits(fixed_advance):
+    # Same comparison as PaintedParagraph.HasSpace: a line as wide as max_width fits
+    text = "abcd efgh"
+    assert list(wrap_text(text, None, 63, breaks=line_breaks(text))) == ["abcd efgh"]
+    assert list(wrap_text(text, None, 62, breaks=line_breaks(text))) == ["abcd ", "efgh"]
+
+
+@pytest.mark.parametrize("optimal", [False, True])
+def test_random_texts(fixed_advance, optimal):
+    rng = random.Random(1)
+    for _ in range(500):
+        text = random_text(rng)
+        max_width = rng.randint(7, 300)
+        lines = list(wrap_text(text, None, max_width, breaks=line_breaks(text), optimal=optimal))
+        assert "".join(lines) == text
+        ends = set(mandatory_breaks(text))
+        pos = 0
+        for line in lines:
+            # The spaces after a word end its line, a line of spaces can only start a paragraph
+            assert line.strip(" ") or pos == 0 or text[pos-1] == "\n", (text, lines)
+            # Only a word without break opportunity is wider than the line
+            assert len(line.rstrip(" \n")) * 7 <= max_width or " " not in line.strip(" \n"), (text, lines)
+            pos += len(line)
+            ends.discard(pos)
+        # Every newline ends a line
+        assert not ends, (text, lines)
+
+
+def wrap_next_lines(text, max_width, first_width=None):
+    """ The lines of chaining wrap_next, the character by character wrapping """
+    text_extends = [0] + GetPartialTextExtents(text, None)
+    pos, width = 0, first_width or max_width
+    while pos < len(text):
+        next_pos = wrap_next(text, text_extends, pos, width)
+        yield text[pos:next_pos]
+        pos, width = next_pos, max_width
+
+
+def test_default_breaks_same_as_wrap_next(fixed_advance):
+    rng = random.Random(2)
+    words = WORDS + ["abcdefghijklmnopqrstuvwxyz0123456789abcd", "a,b", "x_y"]
+    for _ in range(2000):
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(1, 20)))
+        if rng.random() < 0.5:
+            # A line exactly as wide as the width: must not fit
+            end = rng.randint(1, len(text))
+            max_width = len(text[:end]) * 7
+        else:
+            max_width = rng.randint(7, 300)
+        first_width = rng.choice([None, rng.randint(1, max_width)])
+        assert list(wrap_text(text, None, max_width, first_width)) == list(wrap_next_lines(text, max_width, first_width)), \
+            (text, max_width, first_width)
+
+
+def test_line_by_line_same_as_the_whole_text(fixed_advance):
+    """ wrap_line_positions only measures around each line, the lines are the ones of the whole text """
+    rng = random.Random(3)
+    words = WORDS + ["x" * 150, "y" * 70 + "   ", "\r\n"]
+    for _ in range(2000):
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(1, 30)))
+        max_width = rng.randint(7, 700)
+        first_width = rng.choice([None, rng.randint(-50, max_width)])
+        text_extends = [0] + GetPartialTextExtents(text, None)
+        expected = list(wrap_positions(text_extends, line_breaks(text), max_width, first_width, True, 0,
+                                       mandatory_breaks(text), text))
+        assert list(wrap_line_positions(text, None, max_width, first_width)) == expected, (text, max_width, first_width)
+        # From a line start in the middle of the text, as Rewrap does
+        if len(expected) > 2:
+            start = expected[len(expected) // 2 - 1]
+            assert list(wrap_line_positions(text, None, max_width, None, start)) == expected[len(expected) // 2:]